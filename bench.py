@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bench: 离线端到端基准，main.app在本进程中运行，上游全部用fakes代替，
+# 按路由统计吞吐、延迟分位数和内存峰值
+# 用法：python bench.py --users 8 --rounds 5 --compare
+# 默认用mongomock(pip install mongomock)，--mongo-url可指定本地mongod；
+# 每个请求按响应内容判断成败，文档和搜索问答没有检索到上下文也记为错误；
+# 结果追加到bench_results.jsonl(带git提交号)，--compare与其他提交的结果比较
+import os, sys, json, time, argparse, tempfile, threading, subprocess
+import requests
+import fakes
+import harness
+
+RESULTS_PATH = "bench_results.jsonl"
+SAMPLE_INTERVAL = 0.01  # 内存采样间隔(秒)
+
+
+def rss_bytes():
+    # 当前进程的常驻内存：Linux读/proc，其他系统退回到历史峰值
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(object):
+    # 后台线程定时采样：记录一个阶段内的内存峰值
+    def __init__(self):
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            time.sleep(SAMPLE_INTERVAL)
+
+    def start(self):
+        self.peak = rss_bytes()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak, rss_bytes())
+
+
+def check_encoding():
+    # tiktoken的编码表在首次使用时下载：离线运行前要先缓存好
+    import tiktoken
+    try:
+        tiktoken.get_encoding("cl100k_base")
+    except Exception as err:
+        print(f"无法加载tiktoken编码表，请联网运行一次或设置" \
+              f"TIKTOKEN_CACHE_DIR: {err}")
+        sys.exit(1)
+
+
+def start_app(args):
+    # 配置环境变量并把上游换成fakes，再导入main：main在导入时读取配置
+    tmp_dir = tempfile.mkdtemp(prefix="kqa-bench-")
+    upstream = fakes.FakeOpenAIServer(latency=args.latency).start()
+    web = fakes.FakeWebServer(latency=args.latency / 5, \
+                              corpus_dir=args.corpus).start()
+    os.environ.update(DEPLOY_ON_RAILWAY="1", PORT="0", \
+        OPENAI_API_KEY="sk-fake", OPENAI_CHAT_MODEL="gpt-3.5-turbo", \
+        OPENAI_EMBED_MODEL="text-embedding-ada-002", \
+        PINECONE_API_KEY="fake", SERP_API_KEY="fake", \
+        MONGO_URL=args.mongo_url or "mongodb://localhost:27017", \
+        OPENAI_API_BASE=upstream.api_base, TMP_DIR=tmp_dir, \
+        RETRIEVE_MIN_SCORE=str(args.min_score), \
+        WEB_CORPUS_PATH=os.path.join(tmp_dir, "webcorpus.db"))
+    import kqa
+    fakes.FakePinecone.latency = args.latency / 5
+    fakes.FakeGoogle.latency = args.latency
+    fakes.FakeGoogle.web_server = web
+    kqa.Pinecone = fakes.FakePinecone
+    kqa.Google = fakes.FakeGoogle
+    if not args.mongo_url:
+        import mongomock
+        kqa.pymongo = mongomock
+    import main
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    return base_url, web
+
+
+def user_name(i):
+    return f"bench{i}"
+
+
+def session_contexts(http):
+    # 解开会话cookie(本进程有main.app的密钥)，不发请求
+    import main
+    serializer = main.app.session_interface.get_signing_serializer(main.app)
+    return serializer.loads(http.cookies.get('session', '')).get('contexts', [])
+
+
+def make_steps(base_url, web):
+    # [(路由, 是否重复rounds次, 请求函数)]：函数参数为(会话, 用户序号, 轮次)，
+    # 返回是否成功(成功的判断见harness)
+    # 不重复的路由(注册、登录、提示)每个用户只执行一次
+    def register(http, i, r):
+        return harness.register(http, base_url, user_name(i))
+
+    def login(http, i, r):
+        return harness.login(http, base_url, user_name(i))
+
+    def prompt(http, i, r):
+        return harness.set_prompt(http, base_url)
+
+    def upload(http, i, r):
+        return harness.upload(http, base_url, f"文档{r}.txt", i * 1000 + r)
+
+    def crawl(http, i, r):
+        return harness.crawl(http, base_url, web.page_url(i * 100 + r))
+
+    def chat(chattype):
+        def send(http, i, r):
+            ok = harness.ask(http, base_url, f"问题{r}：检索向量的延迟", \
+                             chattype)
+            if ok and chattype != 'direct':
+                # 文档和搜索问答要检索到上下文
+                contexts = session_contexts(http)
+                ok = len(contexts) > 0 and len(contexts[-1]) > 0
+            harness.delete_answer(http, base_url)
+            return ok
+        return send
+
+    def read(http, i, r):
+        return harness.read(http, base_url, 0)
+
+    return [('register', False, register), ('login', False, login), \
+            ('prompt', False, prompt), ('fetch:upload', True, upload), \
+            ('fetch:crawl', True, crawl), \
+            ('chat:direct', True, chat('direct')), \
+            ('chat:document', True, chat('document')), \
+            ('chat:search', True, chat('search')), \
+            ('read', True, read)]
+
+
+def run_step(sessions, rounds, func):
+    # 所有用户同时执行：每个用户rounds次
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def user_loop(i):
+        for r in range(rounds):
+            start = time.perf_counter()
+            try:
+                ok = func(sessions[i], i, r)
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    sampler = RssSampler().start()
+    threads = [threading.Thread(target=user_loop, args=(i,)) \
+               for i in range(len(sessions))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    peak = sampler.stop()
+    latencies.sort()
+    return {'requests': len(latencies), 'errors': errors[0], \
+            'rps': len(latencies) / elapsed, \
+            'p50': harness.percentile(latencies, 0.50), \
+            'p95': harness.percentile(latencies, 0.95), \
+            'p99': harness.percentile(latencies, 0.99), \
+            'peak_rss_mb': peak / 1024 / 1024}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], \
+                    capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', \
+                    '--untracked-files=no'], \
+                    capture_output=True, text=True).stdout.strip() != ""
+    except OSError:
+        return (None, False)
+    return (commit or None, dirty)
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def compare(base, current, threshold):
+    # 打印各路由相对base的变化：吞吐下降或p95上升超过threshold记为回退
+    print(f"比较: {base['commit']} -> {current['commit']}")
+    print(f"{'路由':<14}{'rps':>18}{'p95(s)':>22}{'峰值RSS(MB)':>20}")
+    regressions = []
+    for route, new in current['routes'].items():
+        old = base['routes'].get(route)
+        if not old or not old['p95'] or not new['p95'] or not old['rps']:
+            continue
+        rps_change = new['rps'] / old['rps'] - 1
+        p95_change = new['p95'] / old['p95'] - 1
+        flag = ""
+        if rps_change < -threshold or p95_change > threshold:
+            flag = " 回退"
+            regressions.append(route)
+        print(f"{route:<14}{old['rps']:>8.2f}->{new['rps']:<7.2f}" \
+              f"({rps_change:+.0%})" \
+              f"{old['p95']:>9.3f}->{new['p95']:<7.3f}({p95_change:+.0%})" \
+              f"{old['peak_rss_mb']:>8.0f}->{new['peak_rss_mb']:<6.0f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main.app离线端到端基准")
+    parser.add_argument('--users', type=int, default=8, help="并发用户数")
+    parser.add_argument('--rounds', type=int, default=5, \
+                        help="每个用户在每个路由上的请求数")
+    parser.add_argument('--latency', type=float, default=0.05, \
+                        help="假OpenAI每次调用的延迟(秒)")
+    parser.add_argument('--min-score', type=float, default=0.1, \
+                        help="RETRIEVE_MIN_SCORE：假嵌入的相似度低于真实模型")
+    parser.add_argument('--corpus', help="录制的网页目录(<n>.html)，" \
+                        "没有的网页自动生成")
+    parser.add_argument('--mongo-url', help="使用本地mongod而不是mongomock")
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--compare', nargs='?', const='', metavar='COMMIT', \
+                        help="与该提交(默认为上一个不同提交)的结果比较")
+    parser.add_argument('--threshold', type=float, default=0.1, \
+                        help="判为回退的相对变化")
+    args = parser.parse_args()
+
+    check_encoding()
+    base_url, web = start_app(args)
+    sessions = [requests.Session() for _ in range(args.users)]
+    routes = {}
+    for route, repeated, func in make_steps(base_url, web):
+        rounds = args.rounds if repeated else 1
+        routes[route] = run_step(sessions, rounds, func)
+        print(json.dumps(dict(route=route, **routes[route]), \
+                         ensure_ascii=False))
+    commit, dirty = git_commit()
+    current = {'commit': commit, 'dirty': dirty, \
+               'time': time.strftime("%Y-%m-%d %H:%M:%S"), \
+               'options': {'users': args.users, 'rounds': args.rounds, \
+                           'latency': args.latency, \
+                           'min_score': args.min_score, \
+                           'mongo': 'mongod' if args.mongo_url else 'mongomock'}, \
+               'routes': routes}
+    failed = [route for route, result in routes.items() if result['errors']]
+    if failed:
+        # 有失败请求的结果不保存，也不参与比较
+        print(f"失败的路由: {failed}")
+        sys.exit(1)
+    history = load_results(args.output)
+    if not args.no_save:
+        with open(args.output, 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(current, ensure_ascii=False) + "\n")
+    if args.compare is not None:
+        # 只和相同参数的结果比较
+        candidates = [r for r in history if r['options'] == current['options'] \
+                      and (r['commit'] == args.compare if args.compare \
+                           else r['commit'] != commit)]
+        if not candidates:
+            print("没有可比较的结果")
+            return
+        if compare(candidates[-1], current, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bundle: 知识库的导出和导入，在环境之间迁移用户的文件，不重新解析和嵌入
+# 用法：python bundle.py export alice ./alice.kqa [--dtype float16]
+#       python bundle.py import ./alice.kqa [--user bob] [--batch 500]
+# 需要main的配置(config.json或railway环境变量)
+# 导出目录：manifest.json，files.jsonl(每行一个文件)，vectors.npy(全部节选向量)
+# files.jsonl的row为该文件第一个节选向量在vectors.npy中的行号
+import os, sys, json, time, argparse
+import numpy as np
+import main
+
+BUNDLE_VERSION = 1
+
+
+def find_spans(paragraphs, chunks):
+    # 旧文档只存了节选文本：在全文中依次定位，得到区间
+    text = "".join(paragraphs)
+    spans, cursor = [], 0
+    for chunk in chunks:
+        start = text.find(chunk, cursor)
+        if start < 0:
+            start = text.find(chunk)
+        if start < 0:
+            return None
+        spans.append([start, start + len(chunk)])
+        cursor = start
+    return spans
+
+
+def export_user(name, path, dtype='float16', batch_size=100):
+    os.makedirs(path, exist_ok=True)
+    # 先数出节选总数：向量矩阵直接写入磁盘，不在内存中拼接
+    total = sum(main.mongo.num_chunks(doc) for doc in \
+                main.mongo.find_files_by_user(name, \
+                                        fields=['num_chunks', 'chunks']))
+    dim = main.openai.embed_dim
+    matrix = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), \
+                            mode='w+', dtype=dtype, shape=(total, dim))
+    row, num_files, skipped = 0, 0, []
+    with open(os.path.join(path, 'files.jsonl'), 'w', encoding='utf-8') as fp:
+        for doc in main.mongo.iter_files(name, batch_size=batch_size):
+            if 'paragraphs' not in doc:
+                skipped.append(doc['title'])
+                continue
+            spans = doc.get('spans') or find_spans(doc['paragraphs'], \
+                                                   doc['chunks'])
+            # 内容中存有向量就直接使用，否则从Pinecone取回
+            if 'vectors' in doc and doc['vectors'].data.shape[1] == dim:
+                vectors = doc['vectors'].unpack()
+            else:
+                vectors = main.pinecone.fetch(file_id=doc['fid'], \
+                            num_embeddings=len(doc['chunks']), namespace=name)
+            if spans is None or vectors is None or \
+                    len(vectors) != len(spans) or row + len(spans) > total:
+                skipped.append(doc['title'])
+                continue
+            matrix[row:row+len(spans)] = np.asarray(vectors, dtype=dtype)
+            fp.write(json.dumps({'title': doc['title'], 'row': row, \
+                                 'paragraphs': doc['paragraphs'], \
+                                 'spans': spans}, ensure_ascii=False) + "\n")
+            row += len(spans)
+            num_files += 1
+    matrix.flush()
+    del matrix
+    manifest = {'version': BUNDLE_VERSION, 'user': name, 'dim': dim, \
+                'dtype': dtype, 'num_files': num_files, 'num_vectors': row, \
+                'exported_at': time.strftime("%Y-%m-%d %H:%M:%S")}
+    with open(os.path.join(path, 'manifest.json'), 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, ensure_ascii=False, indent=2)
+    print(f"导出: 用户={name} 文件数={num_files} 向量数={row} " \
+          f"跳过={len(skipped)}{skipped[:5] if skipped else ''}")
+    return manifest
+
+
+def iter_batches(path, batch_size):
+    # 流式读取files.jsonl：每次返回batch_size个文件
+    batch = []
+    with open(os.path.join(path, 'files.jsonl'), encoding='utf-8') as fp:
+        for line in fp:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def import_bundle(path, name=None, batch_size=500):
+    with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as fp:
+        manifest = json.load(fp)
+    if manifest['version'] != BUNDLE_VERSION:
+        raise ValueError(f"不支持的版本: {manifest['version']}")
+    if manifest['dim'] != main.openai.embed_dim:
+        raise ValueError(f"向量维数{manifest['dim']}与嵌入后端" \
+                         f"{main.openai.embed_dim}不一致")
+    name = name or manifest['user']
+    if not main.mongo.find_user(name):
+        print(f"注意: 用户{name}不存在，注册后才能看到导入的文件")
+    # 向量矩阵按需从磁盘读取
+    matrix = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    existing = {doc['title']: doc for doc in \
+                main.mongo.find_files_by_user(name, \
+                                        fields=['title', 'num_chunks', 'chunks'])}
+    start, num_files, num_vectors = time.time(), 0, 0
+    for batch in iter_batches(path, batch_size):
+        # 同名文件：与上传相同，先删除旧文件和嵌入
+        for item in batch:
+            old_doc = existing.pop(item['title'], None)
+            if old_doc:
+                main.mongo.delete_file(name=name, title=item['title'])
+                main.pinecone.delete(file_id=str(old_doc['_id']), \
+                            num_embeddings=main.mongo.num_chunks(old_doc), \
+                            namespace=name)
+        files = []
+        for item in batch:
+            rows = matrix[item['row']:item['row']+len(item['spans'])]
+            files.append((item['title'], item['paragraphs'], item['spans'], \
+                          rows))
+        file_ids = main.mongo.insert_files(name=name, files=files)
+        # 一批文件的向量一起分批并行upsert
+        vectors = []
+        for file_id, (title, paragraphs, spans, rows) in zip(file_ids, files):
+            for chunk_id, values in enumerate(rows):
+                vectors.append((main.pinecone.fid2eid(file_id, chunk_id), \
+                                values.astype(np.float32).tolist(), \
+                                {'file_id': file_id, 'chunk_id': chunk_id}))
+        num_vectors += main.pinecone.upsert(vectors, name)
+        num_files += len(file_ids)
+        print(f"导入: 文件数={num_files} 向量数={num_vectors} " \
+              f"耗时={time.time() - start:.1f}s")
+    return (num_files, num_vectors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="知识库的导出和导入")
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help="导出一个用户的文件")
+    export_parser.add_argument('user')
+    export_parser.add_argument('path', help="导出目录")
+    export_parser.add_argument('--dtype', default='float16', \
+                               choices=['float16', 'float32'])
+    import_parser = commands.add_parser('import', help="导入导出目录")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--user', help="导入到该用户(默认为导出的用户)")
+    import_parser.add_argument('--batch', type=int, default=500, \
+                               help="每次bulk写入的文件数")
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_user(args.user, args.path, dtype=args.dtype)
+    elif args.command == 'import':
+        import_bundle(args.path, name=args.user, batch_size=args.batch)
+    else:
+        parser.print_help()
+        sys.exit(1)
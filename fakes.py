@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# fakes: 本地假上游服务，用于压测和基准测试(不访问外网)
+import os, json, time, zlib, hashlib, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+EMBED_DIM = 1536  # 与text-embedding-ada-002的维数一致
+
+
+def fake_embedding(text, dim=EMBED_DIM):
+    # 由文本内容生成确定的单位向量：每个相邻字对哈希到一个维度上计数，
+    # 含有相同词语的问题和节选相似度为正，检索能召回上下文
+    vector = np.zeros(dim)
+    for i in range(max(len(text) - 1, 0)):
+        vector[zlib.crc32(text[i:i+2].encode('utf-8')) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        # 单字或空文本：退回到由文本哈希生成的随机向量
+        seed = int(hashlib.md5(text.encode('utf-8')).hexdigest()[:8], 16)
+        vector = np.random.RandomState(seed).randn(dim)
+        norm = np.linalg.norm(vector)
+    return (vector / norm).tolist()
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # 默认的监听队列只有5个：并发请求多时新连接会被重置
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # 兼容openai==0.27的/v1/chat/completions和/v1/embeddings接口
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        # 模拟上游的网络和推理延迟
+        time.sleep(self.server.latency)
+        if self.path.endswith('/chat/completions'):
+            question = body['messages'][-1]['content']
+            data = {'id': 'chatcmpl-fake', 'object': 'chat.completion',
+                    'created': int(time.time()), 'model': body.get('model'),
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant',
+                                    'content': "假答案：" + question[-32:]}}],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': 0,
+                              'total_tokens': 0}}
+        elif self.path.endswith('/embeddings'):
+            inputs = body['input']
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            data = {'object': 'list', 'model': body.get('model'),
+                    'data': [{'object': 'embedding', 'index': i,
+                        'embedding': fake_embedding(text, self.server.dim)}
+                             for i, text in enumerate(inputs)],
+                    'usage': {'prompt_tokens': 0, 'total_tokens': 0}}
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # 压测时不打印访问日志
+
+
+class FakeOpenAIServer(object):
+    # 在后台线程中运行的假OpenAI服务
+    def __init__(self, host='127.0.0.1', port=0, latency=0.5, dim=EMBED_DIM):
+        self.httpd = FakeHTTPServer((host, port), FakeOpenAIHandler)
+        self.httpd.latency = latency
+        self.httpd.dim = dim
+        self.thread = threading.Thread(target=self.httpd.serve_forever, \
+                                       daemon=True)
+
+    @property
+    def api_base(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# 生成网页和文档用的词汇：中文正文，按句号分句
+FAKE_WORDS = ["数据", "模型", "检索", "向量", "文档", "问题", "答案", "系统", \
+              "用户", "网页", "节选", "嵌入", "索引", "性能", "延迟", "吞吐"]
+
+
+def fake_paragraphs(seed, num_paragraphs=8, sentences=6):
+    # 由seed生成确定的段落：同一seed总是得到同一篇文档
+    rng = np.random.RandomState(seed)
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        text = ""
+        for _ in range(sentences):
+            words = rng.choice(FAKE_WORDS, rng.randint(6, 16))
+            text += "".join(words) + "。"
+        paragraphs.append(text)
+    return paragraphs
+
+
+def fake_page(seed):
+    # 静态HTML网页：h1为标题，p为段落(crawl_webpage的提取规则)
+    body = "".join(f"<p>{p}</p>" for p in fake_paragraphs(seed))
+    return f"<!DOCTYPE html><html><head><meta charset=\"utf-8\">" \
+           f"<title>网页{seed}</title></head><body><h1>网页{seed}</h1>" \
+           f"{body}</body></html>"
+
+
+class FakeWebHandler(BaseHTTPRequestHandler):
+    # /page/<n>.html：corpus_dir中有录制的网页就返回它，否则生成网页
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        name = os.path.basename(self.path.split('?')[0])
+        seed, ext = os.path.splitext(name)
+        path = os.path.join(self.server.corpus_dir or "", name)
+        if self.server.corpus_dir and os.path.isfile(path):
+            with open(path, 'rb') as fp:
+                payload = fp.read()
+        elif ext == '.html' and seed.isdigit():
+            payload = fake_page(int(seed)).encode('utf-8')
+        else:
+            self.send_error(404)
+            return
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWebServer(FakeOpenAIServer):
+    # 静态网页服务：供crawl_webpage抓取
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, \
+                 corpus_dir=None):
+        self.httpd = FakeHTTPServer((host, port), FakeWebHandler)
+        self.httpd.latency = latency
+        self.httpd.corpus_dir = corpus_dir
+        self.thread = threading.Thread(target=self.httpd.serve_forever, \
+                                       daemon=True)
+
+    def page_url(self, seed):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/page/{seed}.html"
+
+
+class FakeGoogle(object):
+    # 实现kqa.Google的接口：搜索结果指向FakeWebServer的网页
+    web_server = None
+    num_pages = 50    # 网页总数：不同问题命中不同网页
+    num_results = 4   # 每次搜索返回的网页数
+    latency = 0.2
+
+    def __init__(self, serp_api_key=None):
+        pass
+
+    def search(self, query):
+        time.sleep(self.latency)
+        seed = int(hashlib.md5(query.encode('utf-8')).hexdigest()[:8], 16)
+        return [{'title': f"网页{n}", 'link': self.web_server.page_url(n)} \
+                for n in [(seed + i) % self.num_pages \
+                          for i in range(self.num_results)]]
+
+
+class FakePinecone(object):
+    # 内存向量数据库：实现kqa.Pinecone的接口，带模拟的网络延迟
+    latency = 0.1
+
+    def __init__(self, pinecone_api_key=None, dimension=EMBED_DIM, \
+                 pool_threads=4, batch_size=100):
+        self.dimension = dimension
+        self.lock = threading.Lock()
+        self.namespaces = {}  # namespace -> {embed_id: vector}
+
+    @staticmethod
+    def fid2eid(file_id, chunk_id):
+        return file_id + ":" + str(chunk_id)
+
+    @staticmethod
+    def eid2fid(embed_id):
+        file_id, chunk_id = embed_id.rsplit(':', 1)
+        return (file_id, int(chunk_id))
+
+    def insert(self, file_id="", embeddings=[], namespace='', start=0):
+        if not file_id or not embeddings or not namespace:
+            return
+        time.sleep(self.latency)
+        with self.lock:
+            vectors = self.namespaces.setdefault(namespace, {})
+            for i, embedding in enumerate(embeddings):
+                vectors[self.fid2eid(file_id, start + i)] = \
+                                np.array(embedding, dtype=np.float32)
+        return len(embeddings)
+
+    def upsert(self, vectors, namespace):
+        # vectors为(embed_id, values, metadata)
+        time.sleep(self.latency)
+        with self.lock:
+            stored = self.namespaces.setdefault(namespace, {})
+            for embed_id, values, metadata in vectors:
+                stored[embed_id] = np.array(values, dtype=np.float32)
+        return len(vectors)
+
+    def fetch(self, file_id="", num_embeddings=0, namespace=''):
+        with self.lock:
+            vectors = self.namespaces.get(namespace, {})
+            ids = [self.fid2eid(file_id, chunk_id) \
+                   for chunk_id in range(num_embeddings)]
+            if any(embed_id not in vectors for embed_id in ids):
+                return None
+            return [vectors[embed_id].tolist() for embed_id in ids]
+
+    def query(self, query_embedding, namespace='', top_k=1, \
+              include_values=False):
+        if not namespace:
+            return None
+        time.sleep(self.latency)
+        with self.lock:
+            vectors = dict(self.namespaces.get(namespace, {}))
+        if not vectors:
+            return None
+        embed_ids = list(vectors.keys())
+        matrix = np.stack([vectors[eid] for eid in embed_ids])
+        scores = matrix.dot(np.array(query_embedding, dtype=np.float32))
+        order = np.argsort(-scores)[:top_k]
+        result = ([float(scores[i]) for i in order], \
+                  [self.eid2fid(embed_ids[i]) for i in order])
+        if include_values:
+            result += ([matrix[i].tolist() for i in order],)
+        return result
+
+    def delete(self, file_id="", num_embeddings=0, namespace=''):
+        # 与kqa.Pinecone一样按file_id删除全部向量，不依赖节选数
+        if not file_id or not namespace:
+            return
+        time.sleep(self.latency)
+        with self.lock:
+            vectors = self.namespaces.get(namespace, {})
+            for embed_id in list(vectors):
+                if self.eid2fid(embed_id)[0] == file_id:
+                    del vectors[embed_id]
+
+    def delete_ids(self, ids, namespace):
+        with self.lock:
+            vectors = self.namespaces.get(namespace, {})
+            for embed_id in ids:
+                vectors.pop(embed_id, None)
+
+    def count(self, namespace):
+        with self.lock:
+            return len(self.namespaces.get(namespace, {}))
+
+    def list_namespaces(self):
+        with self.lock:
+            return list(self.namespaces)
+
+    def find_orphans(self, namespace, files):
+        with self.lock:
+            embed_ids = list(self.namespaces.get(namespace, {}))
+        orphans = []
+        for embed_id in embed_ids:
+            file_id, chunk_id = self.eid2fid(embed_id)
+            if file_id not in files or chunk_id >= files[file_id]:
+                orphans.append(embed_id)
+        return sorted(orphans)
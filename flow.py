@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# flow: 请求内的阶段依赖图，互不依赖的阶段并发执行，并记录每个阶段的耗时
+import time
+import threading
+import concurrent.futures
+
+POOL_WORKERS = 32
+pools = {}  # 线程名前缀 -> 线程池
+pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    # 线程池在首次使用时才创建：gunicorn预加载时主进程导入flow不会创建线程，
+    # 线程池总是在fork和gevent的monkey patch之后建立
+    pool = pools.get(name)
+    if pool is None:
+        with pools_lock:
+            pool = pools.get(name)
+            if pool is None:
+                pool = concurrent.futures.ThreadPoolExecutor( \
+                            max_workers=POOL_WORKERS, thread_name_prefix=name)
+                pools[name] = pool
+    return pool
+
+
+def stage_pool():
+    # 阶段线程池：执行Flow中的各个阶段
+    return get_pool('stage')
+
+
+def fanout_pool():
+    # 扇出线程池：阶段内部的并行子任务(如同时抓取多个网页)和后台预取
+    # 与阶段线程池分开，阶段等待子任务时不会占满同一个池而死锁
+    return get_pool('fanout')
+
+
+def fanout(func, items):
+    # 并行执行func(item)，按items的顺序返回结果
+    return list(fanout_pool().map(func, items))
+
+
+def background(func, *args):
+    # 后台执行，不等待结果：异常只打印
+    def run():
+        try:
+            func(*args)
+        except Exception as err:
+            print(f"后台任务出错: {func.__name__} error={err}")
+    return fanout_pool().submit(run)
+
+
+class Flow(object):
+    """
+    阶段依赖图：add(name, func, deps)，func的参数是各依赖阶段的结果。
+    run()返回 name -> 结果，timings记录每个阶段的开始和结束时间(秒)。
+    """
+    def __init__(self):
+        self.stages = {}   # name -> (func, deps)
+        self.results = {}
+        self.timings = {}  # name -> (start, end)，相对run()开始的时间
+
+    def add(self, name, func, deps=()):
+        self.stages[name] = (func, tuple(deps))
+        return self
+
+    def run_stage(self, name, origin):
+        func, deps = self.stages[name]
+        start = time.perf_counter() - origin
+        result = func(*[self.results[dep] for dep in deps])
+        self.timings[name] = (start, time.perf_counter() - origin)
+        return result
+
+    def run(self):
+        origin = time.perf_counter()
+        pending = dict(self.stages)
+        running = {}  # future -> name
+        while pending or running:
+            # 提交依赖都已完成的阶段
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in self.results for dep in deps):
+                    future = stage_pool().submit(self.run_stage, name, origin)
+                    running[future] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"阶段依赖无法满足: {list(pending)}")
+            done, _ = concurrent.futures.wait(running, \
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                self.results[name] = future.result()  # 阶段异常直接抛出
+        return self.results
+
+    def critical_path(self):
+        # 从最晚结束的阶段沿着最晚结束的依赖往回走
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while self.stages[name][1]:
+            name = max(self.stages[name][1], key=lambda n: self.timings[n][1])
+            path.append(name)
+        return path[::-1]
+
+    def report(self):
+        stages = " ".join(f"{name}={end-start:.3f}s" \
+                 for name, (start, end) in sorted(self.timings.items(), \
+                                                  key=lambda item: item[1]))
+        total = max((end for start, end in self.timings.values()), default=0)
+        return f"{stages} 总计={total:.3f}s " \
+               f"关键路径={'->'.join(self.critical_path())}"
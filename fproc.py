@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # fproc: file processing
+import os, sys, time, socket, threading, subprocess
+import concurrent.futures
+from multiprocessing.connection import Connection
 import requests
 import chardet
 from bs4 import BeautifulSoup
+from sflight import shared
 
 def find_encoding(response):
     encoding = None
@@ -29,6 +33,7 @@ def find_encoding(response):
         encoding = 'gb18030'
     return encoding or 'latin_1'
 
+@shared('crawl_webpage', method=False)
 def crawl_webpage(url):
     # 下载网页
     try:
@@ -82,5 +87,208 @@ def crawl_webpage(url):
     return (True, (title, paragraphs))
 
 
+"""
+文件解析：pdf/doc/docx在进程池中解析，不占用请求线程的GIL和CPU
+"""
+class ParseError(Exception):
+    pass
 
 
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+                           'fproc_worker.py')
+
+
+class Worker(object):
+    # 一个解析进程：同一时刻只执行一个任务，出问题时只杀掉这个进程
+    # 由fproc_worker.py启动：新的解释器，不继承请求进程中的线程、锁和网络连接，
+    # 也不重新执行启动脚本
+    def __init__(self, memory_limit):
+        parent_sock, child_sock = socket.socketpair()
+        # Connection按阻塞的fd读写：gevent的socket在系统层面总是非阻塞的
+        os.set_blocking(parent_sock.fileno(), True)
+        os.set_blocking(child_sock.fileno(), True)
+        try:
+            self.process = subprocess.Popen([sys.executable, WORKER_PATH, \
+                            str(child_sock.fileno()), str(memory_limit)], \
+                            pass_fds=[child_sock.fileno()])
+        except Exception:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.conn.close()
+
+
+def count_pdf_pages(filepath):
+    import fitz
+    with fitz.open(filepath) as doc:
+        return doc.page_count
+
+
+def extract_pdf_pages(filepath, start, end):
+    # 提取第[start, end)页的段落
+    import fitz
+    paragraphs = []
+    with fitz.open(filepath) as doc:
+        for page_no in range(start, end):
+            text = doc[page_no].get_text()
+            paragraphs.extend(text.split('\n'))
+    return paragraphs
+
+
+def extract_doc(filepath):
+    from unstructured.partition.doc import partition_doc
+    return [str(p) for p in partition_doc(filename=filepath)]
+
+
+def extract_docx(filepath):
+    from unstructured.partition.docx import partition_docx
+    return [str(p) for p in partition_docx(filename=filepath)]
+
+
+class ParsePool(object):
+    """
+    有界的解析进程池：每个任务有超时，每个进程有内存上限；
+    大PDF按页段并行提取，段落按顺序流式返回；
+    每个任务独占一个解析进程，超时从进程开始执行任务时算起，
+    畸形文件导致的崩溃、超时只杀掉执行它的进程，其他任务不受影响。
+    """
+    def __init__(self, max_workers=2, timeout=60, memory_limit=0, \
+                 pages_per_job=16):
+        self.max_workers = max_workers
+        self.timeout = timeout            # 每个任务的超时(秒)
+        self.memory_limit = memory_limit  # 每个进程的内存上限(字节)，0为不限
+        self.pages_per_job = pages_per_job
+        self.cond = threading.Condition()
+        self.idle = []         # 空闲的Worker
+        self.num_workers = 0   # 已启动的进程数(含执行中的)
+
+    def acquire(self):
+        # 取一个空闲进程，没有就启动新进程，达到上限时排队等待
+        with self.cond:
+            while not self.idle and self.num_workers >= self.max_workers:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.num_workers += 1
+        try:
+            return Worker(self.memory_limit)
+        except Exception:
+            self.discard(None)
+            raise
+
+    def release(self, worker):
+        with self.cond:
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def discard(self, worker):
+        # 杀掉卡住或崩溃的进程：下一个任务会启动新进程
+        if worker is not None:
+            worker.kill()
+        with self.cond:
+            self.num_workers -= 1
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            self.discard(worker)
+
+    def run(self, func, *args):
+        worker = self.acquire()
+        try:
+            worker.conn.send((func, args))
+            # 超时从进程收到任务时算起：排队时间不计入
+            if not worker.conn.poll(self.timeout):
+                self.discard(worker)
+                raise ParseError("文件解析超时")
+            okey, result = worker.conn.recv()
+        except (EOFError, OSError):
+            self.discard(worker)
+            raise ParseError("文件解析崩溃")
+        self.release(worker)
+        if okey:
+            return result
+        if isinstance(result, MemoryError):
+            raise ParseError("文件解析内存不足")
+        print(f"解析错误: error={result}")
+        raise ParseError("文件解析失败")
+
+    def iter_pdf(self, filepath):
+        num_pages = self.run(count_pdf_pages, filepath)
+        ranges = [(start, min(start + self.pages_per_job, num_pages)) \
+                  for start in range(0, num_pages, self.pages_per_job)]
+        # 最多max_workers个页段同时解析，按页序返回
+        threads = concurrent.futures.ThreadPoolExecutor( \
+                            max_workers=self.max_workers, \
+                            thread_name_prefix='parse')
+        try:
+            pending = []
+            for start, end in ranges:
+                pending.append(threads.submit(self.run, extract_pdf_pages, \
+                                              filepath, start, end))
+                if len(pending) >= self.max_workers:
+                    yield from pending.pop(0).result()
+            while pending:
+                yield from pending.pop(0).result()
+        finally:
+            threads.shutdown(wait=False, cancel_futures=True)
+
+    def iter_paragraphs(self, filepath, filetype):
+        # 流式返回非空段落，失败时抛出ParseError
+        if filetype == '.txt':
+            with open(filepath, "r") as fp:
+                paragraphs = fp.readlines()
+        elif filetype == '.pdf':
+            paragraphs = self.iter_pdf(filepath)
+        elif filetype == '.doc':
+            paragraphs = self.run(extract_doc, filepath)
+        elif filetype == '.docx':
+            paragraphs = self.run(extract_docx, filepath)
+        else:
+            raise ParseError("文件类型错误")
+        for paragraph in paragraphs:
+            paragraph = str(paragraph).strip()
+            if paragraph != "":
+                yield paragraph
+
+    def parse(self, filepath, filetype):
+        try:
+            paragraphs = list(self.iter_paragraphs(filepath, filetype))
+        except ParseError as err:
+            return (False, str(err))
+        return (True, paragraphs)
+
+
+if __name__ == '__main__':
+    # 解析吞吐量：python fproc.py file.pdf [最大进程数]
+    # 任务函数按模块名pickle：使用导入的fproc，而不是__main__中的同名函数
+    from fproc import ParsePool, count_pdf_pages
+    filepath = sys.argv[1]
+    filetype = os.path.splitext(filepath)[1].lower()
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    num_pages = count_pdf_pages(filepath) if filetype == '.pdf' else None
+    for workers in range(1, max_workers + 1):
+        pool = ParsePool(max_workers=workers, timeout=600)
+        # 预热：先启动全部解析进程并导入解析模块
+        warmup = count_pdf_pages if filetype == '.pdf' else len
+        with concurrent.futures.ThreadPoolExecutor(workers) as threads:
+            list(threads.map(lambda _: pool.run(warmup, filepath), \
+                             range(workers)))
+        start = time.perf_counter()
+        okey, data = pool.parse(filepath, filetype)
+        elapsed = time.perf_counter() - start
+        pool.close()
+        if not okey:
+            print(f"进程数={workers} 解析失败: {data}")
+            break
+        speed = f" 页/秒={num_pages/elapsed:.1f}" if num_pages else ""
+        print(f"进程数={workers} 段落数={len(data)} " \
+              f"耗时={elapsed:.2f}s{speed}")
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# fproc_worker: 解析进程的入口，由fproc.ParsePool启动，不要直接运行
+# 用法：python fproc_worker.py <管道fd> <内存上限(字节)>
+# 单独的入口模块：multiprocessing的spawn会在子进程中重新执行启动脚本
+# (如python main.py的配置、Flask应用和进程池)，这里只导入解析任务用到的模块
+import sys
+from multiprocessing.connection import Connection
+
+
+def limit_memory(memory_limit):
+    # 限制解析进程的地址空间(字节)
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def worker_main(conn, memory_limit):
+    # 从管道接收(func, args)，返回(True, 结果)或(False, 异常)
+    # func按模块名pickle(如fproc.extract_pdf_pages)，首次收到任务时才导入
+    limit_memory(memory_limit)
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = (True, func(*args))
+        except BaseException as err:
+            reply = (False, err)
+        try:
+            conn.send(reply)
+        except Exception as err:  # 异常不能pickle时只传消息
+            conn.send((False, Exception(str(err))))
+
+
+if __name__ == '__main__':
+    worker_main(Connection(int(sys.argv[1])), int(sys.argv[2]))
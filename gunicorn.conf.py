@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# gunicorn配置：gunicorn启动时自动读取当前目录下的gunicorn.conf.py
+# 端口取自PORT环境变量，worker数取自WEB_CONCURRENCY环境变量(gunicorn默认行为)
+import os
+
+# worker类型：sync为每个请求独占一个进程；
+# gevent为协程模式，OpenAI/Pinecone/SerpAPI/MongoDB的网络I/O不再阻塞进程，
+# 一个进程可以同时处理大量进行中的问答
+worker_class = os.getenv("WEB_WORKER_CLASS", "sync")
+# gevent模式下每个worker的最大并发连接数
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "1000"))
+# 请求超时(秒)：问答可能要等待多个上游调用
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))
+# 预加载模式：主进程导入main后再fork出worker，配合PRELOAD_MODULES共享重型模块
+# 服务对象都是延迟创建的，fork之前不会建立任何网络连接
+preload_app = os.getenv("WEB_PRELOAD", "") not in ("", "0", "false")
+
+if worker_class == "gevent":
+    # gevent worker在fork之后才monkey patch：预加载时main已在主进程中导入，
+    # 其中的线程池、锁和队列都是真正的线程原语，第一个阻塞在上面的协程会冻结
+    # 整个worker。所以在导入应用之前先patch(不预加载时与worker中的patch相同)
+    from gevent import monkey
+    monkey.patch_all()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# harness: bench.py和loadtest.py共用的请求和统计
+# 出错页面也是200：不跟随重定向，成功的表单提交返回302，注册返回登录页
+import requests
+import fakes
+
+TIMEOUT = 120  # 每个请求的超时(秒)：问答可能要等待多个上游调用
+PROMPT = "你是一个测试助理"
+
+
+def register(http, base_url, name):
+    # 用户已存在也算成功：可以对同一个数据库重复运行
+    response = http.post(base_url + "/register", timeout=TIMEOUT, \
+                         data={'name': name, 'pwd': name, 'pwd2': name})
+    return response.status_code == 200 and \
+           ("注册成功" in response.text or "账号存在" in response.text)
+
+
+def login(http, base_url, name):
+    return http.post(base_url + "/login", timeout=TIMEOUT, \
+                     allow_redirects=False, \
+                     data={'name': name, 'pwd': name}).status_code == 302
+
+
+def set_prompt(http, base_url):
+    return http.post(base_url + "/prompt", timeout=TIMEOUT, \
+                     allow_redirects=False, \
+                     data={'submit': '提交', 'prompt': PROMPT}).status_code == 302
+
+
+def upload(http, base_url, title, seed):
+    # 上传一篇由seed生成的假文档
+    text = "\n".join(fakes.fake_paragraphs(seed, num_paragraphs=24))
+    return http.post(base_url + "/fetch", timeout=TIMEOUT, \
+                     allow_redirects=False, data={'submit': '上传文件'}, \
+                     files={'file': (title, text.encode('utf-8'))} \
+                     ).status_code == 302
+
+
+def crawl(http, base_url, url):
+    return http.post(base_url + "/fetch", timeout=TIMEOUT, \
+                     allow_redirects=False, \
+                     data={'submit': '抓取网页', 'url': url}).status_code == 302
+
+
+def ask(http, base_url, question, chattype):
+    # 问题要含有假文档中的词语，文档和搜索问答才能检索到上下文
+    return http.post(base_url + "/chat", timeout=TIMEOUT, \
+                     allow_redirects=False, data={'submit': '发送', \
+                        'question': question, 'chattype': chattype} \
+                     ).status_code == 302
+
+
+def delete_answer(http, base_url):
+    # 删除第一轮问答：避免session的cookie越来越大
+    http.post(base_url + "/chat", timeout=TIMEOUT, allow_redirects=False, \
+              data={'submit': '删除', 'message_idx': 1})
+
+
+def read(http, base_url, title_id):
+    # 找不到文件时重定向到首页
+    return http.get(base_url + "/read", timeout=TIMEOUT, \
+                    allow_redirects=False, \
+                    params={'tid': title_id}).status_code == 200
+
+
+def prepare_user(base_url, name, seed):
+    # 注册、登录、设置提示并上传一篇假文档：返回带cookie的会话
+    # 文档问答检索该用户的namespace，没有文档时上下文总是空的
+    http = requests.Session()
+    steps = [('注册', lambda: register(http, base_url, name)), \
+             ('登录', lambda: login(http, base_url, name)), \
+             ('设置提示', lambda: set_prompt(http, base_url)), \
+             ('上传文档', lambda: upload(http, base_url, "压测文档.txt", seed))]
+    for step, func in steps:
+        if not func():
+            raise RuntimeError(f"{name}{step}失败")
+    return http
+
+
+def percentile(latencies, p):
+    # latencies已排序
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
@@ -1,21 +1,61 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # KQA: Knowledge Question Answering
-import re
+import re, time, json, queue, sqlite3, hashlib, threading, collections, \
+       contextlib
 import numpy as np
 import pymongo
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 from werkzeug.security import generate_password_hash, check_password_hash
 import openai
 import tiktoken
-import pinecone
-from serpapi import GoogleSearch
-import chromadb
-from chromadb.utils import embedding_functions
+from sflight import shared
+import vec
+try:
+    import zstandard  # 可选：压缩file文档中的段落
+except ImportError:
+    zstandard = None
+# pinecone、serpapi导入较慢，在首次使用时才导入
+
+
+def hash_paragraphs(paragraphs):
+    # 规范化段落(去掉首尾空白，合并连续空白)后的sha256：相同内容得到相同哈希
+    text = "\n".join(" ".join(p.split()) for p in paragraphs)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class Lazy(object):
+    """
+    延迟创建的服务：首次访问属性时才调用factory创建真正的对象。
+    导入main时不做任何网络连接，gunicorn预加载后fork也不会共享连接。
+    """
+    def __init__(self, factory, *args, **kwargs):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:  # 多线程同时首次使用时只创建一次
+                if self._instance is None:
+                    self._instance = self._factory(*self._args, \
+                                                   **self._kwargs)
+        return self._instance
+
+    @property
+    def initialized(self):
+        return self._instance is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
 
 
 class MongoDB(object):
-    def __init__(self, mongo_url):
+    def __init__(self, mongo_url, cache_size=256, cache_ttl=300, \
+                 compression=''):
         # 获得MongoDB客户端
         self.mongo_cli = pymongo.MongoClient(mongo_url)
         # 获取MongoDB数据库
@@ -24,6 +64,20 @@ class MongoDB(object):
         self.user_col = self.mongo_db['users']
         # 获取文件集合
         self.file_col = self.mongo_db['files']
+        # 获取内容集合
+        self.content_col = self.mongo_db['contents']
+        # 文件缓存：fid -> (缓存时间, 元数据)，按最近使用淘汰，命中时确认文件存在
+        # 内容缓存：内容哈希 -> 还原后的段落和节选，哈希相同内容就相同，不会过时
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.file_cache = collections.OrderedDict()
+        self.content_cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        # 段落的压缩方式：''为不压缩，'zstd'需要安装zstandard
+        if compression == 'zstd' and zstandard is None:
+            print("没有安装zstandard：段落不压缩")
+            compression = ''
+        self.compression = compression
         
     """
     users集合：存储每个用户的个人信息 
@@ -84,40 +138,173 @@ class MongoDB(object):
     
     """
     files集合：存储每个文件的文本信息 
-    file文档：_id域，name域, title域，paragraphs域
+    file文档：_id域，name域, title域，content域(contents集合中的内容哈希)，
+    num_chunks域；旧的file文档直接存储paragraphs域和chunks域
+    contents集合：按内容哈希存储去重后的文件内容，多个用户的同一文件共享
+    content文档：_id域(内容哈希)，paragraphs域(或压缩的paragraphs_z域)，
+    spans域：各节选在"".join(paragraphs)中的[start, end]，
+    vectors域：float16的节选向量，dim域：向量维数，refs域：引用计数
     """
-    def insert_file(self, name="", title="", paragraphs=[], chunks=[]):
-        if not name or not title or not paragraphs or not chunks:
+    MAX_VECTOR_BYTES = 12 * 1024 * 1024  # 向量太大时不存(文档上限16MB)
+    FILE_FIELDS = ['name', 'title', 'content', 'num_chunks']  # 元数据域
+
+    def insert_file(self, name="", title="", paragraphs=[], spans=[], \
+                    embeddings=[]):
+        if not name or not title or not paragraphs or not spans:
             return None
         # 已经存在就先删掉
         if self.file_exist(name, title):
             self.delete_file(name=name, title=title)
-        # 新增文件记录
-        doc = {'name':name, 'title':title, \
-               'paragraphs':paragraphs, 'chunks':chunks}
+        # 新增文件记录：内容存到contents集合，文件只引用内容哈希
+        content_hash = self.acquire_content(paragraphs, spans, embeddings)
+        doc = {'name':name, 'title':title, 'content':content_hash, \
+               'num_chunks':len(spans)}
         res = self.file_col.insert_one(doc)
         file_id = str(res.inserted_id)
         return file_id
     
-    def update_file(self, name="", title="", paragraphs=[], chunks=[]):
-        if not name or not title or not paragraphs or not chunks:
+    def update_file(self, name="", title="", paragraphs=[], spans=[], \
+                    embeddings=[]):
+        if not name or not title or not paragraphs or not spans:
             return None
         # 先保证已经存在
-        if not self.file_exist(name, title):
+        old_doc = self.file_col.find_one({'name':name, 'title':title})
+        if not old_doc:
             return None
         # 再更新文件记录
+        self.uncache_file(name, title)
+        content_hash = self.acquire_content(paragraphs, spans, embeddings)
         query = {'name':name, 'title':title}
-        update = {"$set": {'paragraphs':paragraphs, 'chunks':chunks}}
+        update = {"$set": {'content':content_hash, 'num_chunks':len(spans)}, \
+                  "$unset": {'paragraphs':"", 'chunks':""}}
         res = self.file_col.update_one(query, update)
+        if 'content' in old_doc:
+            self.release_content(old_doc['content'])
         #匹配query的就只有一个：res.matched_count == 1
         #res.modified_count为1表示paragraphs已修改，为0表示内容没修改。
         return res.modified_count
-    
-    def find_files_by_user(self, name=""):
+
+    def acquire_content(self, paragraphs, spans, embeddings):
+        # 新增内容或给已有内容加一个引用：返回内容哈希
+        content_hash, update = self.content_update(paragraphs, spans, embeddings)
+        self.content_col.update_one({'_id':content_hash}, update, upsert=True)
+        return content_hash
+
+    def content_update(self, paragraphs, spans, embeddings):
+        # 返回(内容哈希, update)：update_one和bulk_write共用
+        content_hash = hash_paragraphs(paragraphs)
+        content = {'spans':spans}
+        content.update(self.pack_paragraphs(paragraphs))
+        if len(embeddings):
+            vectors = vec.PackedVectors.pack(embeddings, 'float16').to_bytes()
+            if len(vectors) < self.MAX_VECTOR_BYTES:
+                content['vectors'] = vectors
+                content['dim'] = len(embeddings[0])
+        return (content_hash, {'$setOnInsert':content, '$inc':{'refs':1}})
+
+    def insert_files(self, name="", files=[]):
+        """
+        批量新增文件(导入用)：files为[(title, paragraphs, spans, embeddings)]，
+        标题不能与已有文件重复。内容和文件各一次bulk写入，返回file_id列表。
+        """
+        if not name or not files:
+            return []
+        requests, docs = [], []
+        for title, paragraphs, spans, embeddings in files:
+            content_hash, update = self.content_update(paragraphs, spans, \
+                                                       embeddings)
+            requests.append(UpdateOne({'_id':content_hash}, update, \
+                                              upsert=True))
+            docs.append({'name':name, 'title':title, 'content':content_hash, \
+                         'num_chunks':len(spans)})
+        self.content_col.bulk_write(requests, ordered=False)
+        res = self.file_col.insert_many(docs, ordered=True)
+        return [str(file_id) for file_id in res.inserted_ids]
+
+    def iter_files(self, name="", batch_size=100):
+        """
+        按批次读取用户的全部文件(导出用)：每批的内容一次$in查询。
+        返回还原后的file文档，内容中存有向量时带上vectors域(PackedVectors)。
+        """
+        cursor = self.file_col.find({'name':name}, batch_size=batch_size)
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield from self.materialize_batch(batch)
+                batch = []
+        yield from self.materialize_batch(batch)
+
+    def materialize_batch(self, docs):
+        hashes = [doc['content'] for doc in docs if 'content' in doc]
+        contents = {}
+        if hashes:
+            for content in self.content_col.find({'_id':{'$in':hashes}}):
+                contents[content.pop('_id')] = content
+        for doc in docs:
+            content = contents.get(doc.pop('content', None))
+            if content:
+                content = dict(content)
+                if 'vectors' in content:
+                    content['vectors'] = \
+                        vec.PackedVectors.from_bytes(content['vectors'])
+                doc.update(content)
+            doc['fid'] = str(doc['_id'])
+            yield self.materialize(doc)
+
+    def release_content(self, content_hash):
+        # 去掉一个引用：没有文件引用时删除内容
+        self.content_col.update_one({'_id':content_hash}, \
+                                    {'$inc':{'refs':-1}})
+        self.content_col.delete_one({'_id':content_hash, 'refs':{'$lte':0}})
+
+    def find_content(self, paragraphs=[], dim=0):
+        # 相同内容已经切分和嵌入过：返回(spans, embeddings)，否则返回None
+        content_hash = hash_paragraphs(paragraphs)
+        content = self.content_col.find_one({'_id':content_hash, 'dim':dim}, \
+                                projection={'spans':1, 'vectors':1})
+        if not content or 'vectors' not in content:
+            return None
+        packed = vec.PackedVectors.from_bytes(content['vectors'])
+        return (content['spans'], packed.unpack().tolist())
+
+    def pack_paragraphs(self, paragraphs):
+        if self.compression == 'zstd':
+            data = json.dumps(paragraphs, ensure_ascii=False).encode('utf-8')
+            return {'paragraphs_z': zstandard.ZstdCompressor().compress(data)}
+        return {'paragraphs': paragraphs}
+
+    def materialize(self, doc):
+        # 还原段落和节选：find_file等返回的文档都有paragraphs和chunks域
+        if 'content' in doc:
+            content = self.content_col.find_one({'_id':doc['content']}, \
+                            projection={'paragraphs':1, 'paragraphs_z':1, \
+                                        'spans':1})
+            if content:
+                content.pop('_id')
+                doc.update(content)
+        if 'paragraphs_z' in doc:
+            data = zstandard.ZstdDecompressor().decompress(doc['paragraphs_z'])
+            doc['paragraphs'] = json.loads(data.decode('utf-8'))
+            del doc['paragraphs_z']
+        if 'spans' in doc and 'chunks' not in doc:
+            text = "".join(doc['paragraphs'])
+            doc['chunks'] = [text[start:end] for start, end in doc['spans']]
+        return doc
+
+    @staticmethod
+    def num_chunks(doc):
+        # 不用还原节选就能得到节选数
+        if 'num_chunks' in doc:
+            return doc['num_chunks']
+        return len(doc['chunks'])
+
+    def find_files_by_user(self, name="", fields=None):
+        # fields为要返回的域，如['title']：不传输整篇文件
         if not name:
             return []
         query = {'name':name}
-        results = list(self.file_col.find(query))
+        results = list(self.file_col.find(query, projection=fields))
         # result可能为[]
         return results
 
@@ -129,21 +316,155 @@ class MongoDB(object):
             query['title'] = title
         if file_id:
             query['_id'] = ObjectId(file_id)
-        result = list(self.file_col.find(query))
-        if result == []:
-            return None
-        doc = result[0]
-        doc['fid'] = str(doc['_id'])
-        return doc
+        meta = None
+        if file_id and not title:
+            meta = self.get_cached_file(file_id)
+            # 文件可能已被其他worker删除：缓存命中也要确认文件仍然存在
+            if meta and (meta['name'] != name or \
+                    self.file_col.count_documents(query, limit=1) == 0):
+                self.drop_cached_file(file_id)
+                meta = None
+        if meta is None:
+            metas = self.load_files(query)
+            if metas == []:
+                return None
+            meta = metas[0]
+            self.cache_file(meta)
+        docs = self.materialize_files([meta])
+        return docs[0] if docs else None
+
+    def find_files(self, name="", file_ids=[]):
+        # 一次查询多个文件：返回fid -> file文档，不存在的fid不在结果中
+        if not name or not file_ids:
+            return {}
+        cached, missing = {}, []
+        for file_id in set(file_ids):
+            meta = self.get_cached_file(file_id)
+            if meta and meta['name'] == name:
+                cached[file_id] = meta
+            else:
+                missing.append(ObjectId(file_id))
+        if cached:
+            # 文件可能已被其他worker删除：一次查询确认缓存的文件仍然存在
+            query = {'name':name, \
+                     '_id':{'$in':[ObjectId(fid) for fid in cached]}}
+            alive = {str(doc['_id']) for doc in \
+                     self.file_col.find(query, projection={'_id':1})}
+            for file_id in set(cached) - alive:
+                self.drop_cached_file(file_id)
+                del cached[file_id]
+        metas = list(cached.values())
+        if missing:
+            for meta in self.load_files({'name':name, '_id':{'$in':missing}}):
+                self.cache_file(meta)
+                metas.append(meta)
+        return {doc['fid']: doc for doc in self.materialize_files(metas)}
+
+    def prefetch_files(self, name=""):
+        # 登录时预取用户文件的元数据(标题、节选数、内容哈希)：
+        # 段落和节选在问答用到时才读取和还原
+        query = {'name':name}
+        for meta in self.load_files(query, limit=self.cache_size):
+            self.cache_file(meta)
+
+    def load_files(self, query, limit=0):
+        # 只读取file文档的元数据，不传输段落
+        metas = []
+        for doc in self.file_col.find(query, projection=self.FILE_FIELDS, \
+                                      limit=limit):
+            doc['fid'] = str(doc['_id'])
+            metas.append(doc)
+        return metas
+
+    def materialize_files(self, metas):
+        """
+        元数据 -> 完整的file文档(有paragraphs和chunks域)。
+        内容按哈希缓存：同一哈希的内容不会改变，各worker的缓存都不会过时；
+        缓存中没有的内容一次$in查询；旧的file文档直接读取整个文档。
+        """
+        missing = [meta['content'] for meta in metas if 'content' in meta \
+                   and self.get_cached_content(meta['content']) is None]
+        if missing:
+            query = {'_id':{'$in':missing}}
+            for content in self.content_col.find(query, \
+                    projection={'paragraphs':1, 'paragraphs_z':1, 'spans':1}):
+                content_hash = content.pop('_id')
+                self.cache_content(content_hash, self.materialize(content))
+        legacy = [meta['_id'] for meta in metas if 'content' not in meta]
+        legacy_docs = {}
+        if legacy:
+            for doc in self.file_col.find({'_id':{'$in':legacy}}):
+                legacy_docs[doc['_id']] = self.materialize(doc)
+        docs = []
+        for meta in metas:
+            if 'content' in meta:
+                content = self.get_cached_content(meta['content'])
+            else:
+                content = legacy_docs.get(meta['_id'])
+            if content is None:
+                continue
+            doc = dict(meta)
+            doc.update(paragraphs=content['paragraphs'], \
+                       chunks=content['chunks'])
+            docs.append(doc)
+        return docs
+
+    def cache_file(self, meta):
+        with self.cache_lock:
+            self.file_cache[meta['fid']] = (time.time(), meta)
+            self.file_cache.move_to_end(meta['fid'])
+            while len(self.file_cache) > self.cache_size:
+                self.file_cache.popitem(last=False)
+
+    def get_cached_file(self, file_id):
+        with self.cache_lock:
+            item = self.file_cache.get(file_id)
+            if item is None:
+                return None
+            cached_at, meta = item
+            if time.time() - cached_at > self.cache_ttl:
+                del self.file_cache[file_id]
+                return None
+            self.file_cache.move_to_end(file_id)
+            return meta
+
+    def drop_cached_file(self, file_id):
+        with self.cache_lock:
+            self.file_cache.pop(file_id, None)
+
+    def cache_content(self, content_hash, content):
+        with self.cache_lock:
+            self.content_cache[content_hash] = content
+            self.content_cache.move_to_end(content_hash)
+            while len(self.content_cache) > self.cache_size:
+                self.content_cache.popitem(last=False)
+
+    def get_cached_content(self, content_hash):
+        with self.cache_lock:
+            content = self.content_cache.get(content_hash)
+            if content is not None:
+                self.content_cache.move_to_end(content_hash)
+            return content
+
+    def uncache_file(self, name, title):
+        with self.cache_lock:
+            for file_id, (cached_at, meta) in list(self.file_cache.items()):
+                if meta['name'] == name and meta['title'] == title:
+                    del self.file_cache[file_id]
     
     def file_exist(self, name="", title=""):
-        return (self.find_file(name, title) != None)
+        query = {'name':name, 'title':title}
+        return self.file_col.count_documents(query, limit=1) > 0
 
     def delete_file(self, name="", title=""):
         if not name or not title:
             return
+        self.uncache_file(name, title)
         query = {'name':name, 'title':title}
-        self.file_col.delete_one(query)
+        doc = self.file_col.find_one_and_delete(query, projection={'content':1})
+        # 其他用户可能还引用着同一内容：按引用计数删除
+        if doc and 'content' in doc:
+            self.release_content(doc['content'])
         return
 
 
@@ -152,17 +473,40 @@ class OpenAI(object):
     MIDDLE_TOKENS = 384  # 每个chunk的期望token数
     MAX_TOKENS = 512     # 每个chunk的最大token数
     
+    OPENAI_EMBED_DIM = 1536  # OpenAI的Embedding API的维数
+    EMBED_BATCH = 64         # 每次嵌入调用最多的文本数
+
     def __init__(self, openai_api_key, \
-                 openai_chat_model, openai_embed_model):
+                 openai_chat_model, openai_embed_model, openai_api_base=None, \
+                 embedder=None, gate=None):
         # 设置openai的api key
         openai.api_key = openai_api_key
+        # 设置openai的api地址：默认为https://api.openai.com/v1
+        if openai_api_base:
+            openai.api_base = openai_api_base
         # chat_model"gpt-3.5-turbo"或"gpt-4"
         self.chat_model = openai_chat_model
         self.embed_model = openai_embed_model
+        # 本地嵌入模型：为None时使用OpenAI的Embedding API
+        self.embedder = embedder
+        # 上游调用的优先级闸门(prio.Gate)：为None时不限制并发
+        self.gate = gate
+        self._encoding = None
+
+    def slot(self):
+        if self.gate is None:
+            return contextlib.nullcontext()
+        return self.gate.slot()
+
+    @property
+    def encoding(self):
+        # 首次分词时才加载编码表(可能需要下载)
         # cl100k_base编码用在gpt-4、gpt-3.5-turbo、text-embedding-ada-002上
         # self.encoding = tiktoken.encoding_for_model("gpt-4")
         # self.encoding = tiktoken.encoding_for_model("text-embedding-ada-002")
-        self.encoding = tiktoken.get_encoding("cl100k_base")
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
     
     """
     chat模型：OpenAI的chatgpt或gpt4
@@ -171,7 +515,8 @@ class OpenAI(object):
         err_msg = ""
         try:
             #Make your OpenAI API request here
-            completion = openai.ChatCompletion.create(
+            with self.slot():
+                completion = openai.ChatCompletion.create(
                                         model=self.chat_model,
                                         messages=messages,
                                         temperature=0.6,
@@ -204,59 +549,105 @@ class OpenAI(object):
         return (True, answer)
     
     """
-    embedding模型：OpenAI的text-embedding-ada-002
+    embedding模型：OpenAI的text-embedding-ada-002或本地的LocalEmbedder
     """
-    # 嵌入query
-    def embed_query(self, query):
-        result = openai.Embedding.create(input=query, \
+    @property
+    def embed_dim(self):
+        if self.embedder:
+            return self.embedder.dimension
+        return self.OPENAI_EMBED_DIM
+
+    # 嵌入多个文本：整篇文档分成小批次，每批单独排队，
+    # 摄取大文档时问答的嵌入可以插在批次之间
+    def embed_texts(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.EMBED_BATCH):
+            with self.slot():
+                embeddings.extend(self.embed_batch(texts[i:i+self.EMBED_BATCH]))
+        return embeddings
+
+    def embed_batch(self, texts):
+        if self.embedder:
+            return self.embedder.embed(texts)
+        result = openai.Embedding.create(input=texts, \
                                          model=self.embed_model)
-        embedding = result['data'][0]['embedding']
+        embeddings = [item['embedding'] for item in result['data']]
+        return embeddings
+
+    # 嵌入query：同时发生的相同query只调用一次
+    @shared('embed_query')
+    def embed_query(self, query):
+        embedding = self.embed_texts([query])[0]
         return embedding
     
     # 嵌入document
     def embed_document(self, paragraphs):
+        chunks, spans = self.chunk_document(paragraphs)
+        if len(chunks) == 0:
+            return ([], [])
+        embeddings = self.embed_texts(chunks)
+        return (chunks, embeddings)
+
+    # 切分document：返回区块文本和区块在全文中的(start, end)
+    # 全文为"".join(paragraphs)，区块可由区间还原，不必重复存储文本
+    def chunk_document(self, paragraphs):
+        text, pieces = self.split_document(paragraphs)
+        spans = self.merge_chunks(pieces)
+        chunks = [text[start:end] for start, end in spans]
+        return (chunks, spans)
+
+    # 分割document：段落或段落的片段在全文中的(start, end)
+    def split_document(self, paragraphs):
+        text = "".join(paragraphs)
         chunks = []
+        start = 0
         for paragraph in paragraphs:
+            end = start + len(paragraph)
             num_tokens = len(self.encoding.encode(paragraph))
             if num_tokens < self.MAX_TOKENS:
-                chunks.append(paragraph)
+                chunks.append((start, end))
             else:
-                paragraph_chunks = self.split_paragraph(paragraph)
-                chunks.extend(paragraph_chunks)
-        new_chunks = self.merge_chunks(chunks)
-        if len(new_chunks) == 0:
-            return ([], [])
-        result = openai.Embedding.create(input=new_chunks, \
-                                         model=self.embed_model)
-        embeddings = [item['embedding'] for item in result['data']]
-        return (new_chunks, embeddings)
-        
+                # 段落的片段都是段落的子串：按顺序定位
+                cursor = start
+                for piece in self.split_paragraph(paragraph):
+                    offset = text.find(piece, cursor, end) if piece else -1
+                    if offset < 0:
+                        continue
+                    chunks.append((offset, offset + len(piece)))
+                    cursor = offset + len(piece)
+            start = end
+        return (text, chunks)
+
     # 合并区块：有重叠部分
+    # chunks为区块的(start, end)，合并后的区块也是(start, end)
     def merge_chunks(self, chunks):
         if len(chunks) == 0:
             return []
+        length = lambda span: (span[1] - span[0]) if span else 0
         # 尽量让每个chunk的token数接近并<= MIDDEL_TOKENS
         new_chunks = []
         chunk = chunks[0]
         for i in range(1, len(chunks)):
-            if len(chunk) + len(chunks[i]) < self.MIN_TOKENS:
-                chunk += chunks[i]
+            if length(chunk) + length(chunks[i]) < self.MIN_TOKENS:
+                chunk = (chunk[0], chunks[i][1])
                 if i == len(chunks) - 1:
                     # 如果不超过MAX_TOKENS，可以合并最后两个新的chunk
                     if len(new_chunks) > 0 and \
-                        len(new_chunks[-1][0])+ len(chunk) < self.MAX_TOKENS:
+                        length(new_chunks[-1][0]) + length(chunk) \
+                            < self.MAX_TOKENS:
                         new_chunks[-1][1] = chunk
                     else: # 几乎不进来：前一个chunk略>256，后一个chunk<256
-                        new_chunks.append([chunk, ""]) # overlap为""
+                        new_chunks.append([chunk, None]) # overlap为空
             else:
                 is_ended = False
                 # 让前后两个chunk的重叠token数为MIDDLE_TOKENS - MIN_TOKENS
                 # 也就是说chunk和overlap的token数接近并 <= MIDDLE_TOKENS
-                overlap = ""
+                overlap = None
                 for j in range(i, len(chunks)):
-                    if len(chunk) + len(overlap) + len(chunks[j]) \
+                    if length(chunk) + length(overlap) + length(chunks[j]) \
                             < self.MIDDLE_TOKENS:
-                        overlap += chunks[j]
+                        overlap = (overlap[0] if overlap else chunks[j][0], \
+                                   chunks[j][1])
                         if j == len(chunks) - 1:
                             is_ended = True
                     else:
@@ -265,16 +656,15 @@ class OpenAI(object):
                 chunk = chunks[i]
                 if is_ended:
                     break;
-        new_chunks = [new_chunks[i][0] + new_chunks[i][1] \
-                              for i in range(len(new_chunks))]
+        # chunk和紧随其后的overlap拼成一个区间
+        new_chunks = [[chunk[0], (overlap or chunk)[1]] \
+                      for chunk, overlap in new_chunks]
         return new_chunks
                 
     # 合并句子：没有重叠部分
     def merge_sentences(self, sentences, num_chunks):
-        data = openai.Embedding.create(input=sentences, \
-                        model=self.embed_model)['data']
-        # data[i]['embedding']类型为python list，需要转为numpy array
-        embeddings = [np.array(item['embedding']) for item in data]
+        # 嵌入类型为python list，需要转为numpy array
+        embeddings = [np.array(e) for e in self.embed_texts(sentences)]
         num_tokens = [len(self.encoding.encode(s)) for s in sentences]
         chunks = [{'text':sentences[i], 'embedding':embeddings[i],\
                    'num_tokens':num_tokens[i], 'num_sentences':1} \
@@ -325,7 +715,7 @@ class OpenAI(object):
             chunk_length = int(len(paragraph) / (num_chunks+1))
             chunks = []
             for i in range(num_chunks+1):
-                chunks.append(paragraph[i*chunk_length, (i+1)*chunk_length])
+                chunks.append(paragraph[i*chunk_length:(i+1)*chunk_length])
             return chunks
         
         # len(sentences) > num_chunks
@@ -334,14 +724,117 @@ class OpenAI(object):
         return chunks
         
 
+class LocalEmbedder(object):
+    """
+    本地CPU嵌入模型(sentence-transformers)：每个进程只加载一次。
+    并发请求由后台线程合并成小批次一起推理(动态micro-batching)。
+    """
+    def __init__(self, model_name, num_threads=0, quantize=False, \
+                 max_batch=64, max_wait=0.005):
+        self.model_name = model_name
+        self.num_threads = num_threads  # torch的CPU线程数，0为默认
+        self.quantize = quantize        # 是否把Linear层动态量化为int8
+        self.max_batch = max_batch      # 每批最多的文本数
+        self.max_wait = max_wait        # 凑批次的最长等待(秒)
+        self.model = None
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.worker = None
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+                if self.num_threads:
+                    torch.set_num_threads(self.num_threads)
+                model = SentenceTransformer(self.model_name, device='cpu')
+                if self.quantize:
+                    model = torch.quantization.quantize_dynamic( \
+                                model, {torch.nn.Linear}, dtype=torch.qint8)
+                self.model = model
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+        return self.model
+
+    @property
+    def dimension(self):
+        return self.load().get_sentence_embedding_dimension()
+
+    def embed(self, texts):
+        self.load()
+        if len(texts) >= self.max_batch:
+            # 大批量(如整篇文档)直接推理，不必排队
+            return self.encode(texts)
+        request = {'texts': texts, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['embeddings']
+
+    def encode(self, texts):
+        # 归一化后的向量：余弦相似度等于内积
+        embeddings = self.model.encode(texts, batch_size=self.max_batch, \
+                            convert_to_numpy=True, normalize_embeddings=True)
+        return embeddings.tolist()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            num_texts = len(batch[0]['texts'])
+            deadline = time.time() + self.max_wait
+            while num_texts < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_texts += len(request['texts'])
+            texts = [text for request in batch for text in request['texts']]
+            try:
+                embeddings = self.encode(texts)
+            except Exception as err:
+                for request in batch:
+                    request['error'] = err
+                    request['done'].set()
+                continue
+            start = 0
+            for request in batch:
+                end = start + len(request['texts'])
+                request['embeddings'] = embeddings[start:end]
+                request['done'].set()
+                start = end
+
+
 class Pinecone(object):
-    def __init__(self, pinecone_api_key):
+    """
+    每个向量的id为"file_id:chunk_id"，metadata中也存file_id和chunk_id：
+    删除文件时按file_id过滤，不依赖节选数；对账时按metadata找出孤儿向量。
+    """
+    BATCH_SIZE = 100     # 每次upsert的向量数：整篇文档一次upsert会超过请求大小
+    DELETE_BATCH = 1000  # 每次按id删除的向量数上限
+    MAX_TOP_K = 10000    # 不返回向量时query的top_k上限
+
+    def __init__(self, pinecone_api_key, dimension=1536, pool_threads=4, \
+                 batch_size=BATCH_SIZE):
+        import pinecone
         pinecone.init(api_key=pinecone_api_key, environment="us-west1-gcp-free")
-        self.index_name = 'kqa'
+        # 不同维数的向量放在不同的索引中：1536维(OpenAI)沿用原来的kqa索引
+        self.dimension = dimension
+        if dimension == 1536:
+            self.index_name = 'kqa'
+        else:
+            self.index_name = f'kqa-{dimension}'
         if self.index_name not in pinecone.list_indexes():
-            # OpenAI的Embedding API的维数是1536
-            pinecone.create_index(name=self.index_name, dimension=1536)
-        self.index = pinecone.Index(index_name=self.index_name)
+            pinecone.create_index(name=self.index_name, dimension=dimension)
+        # pool_threads：异步请求(async_req)的线程数，即同时进行的upsert数
+        self.index = pinecone.Index(index_name=self.index_name, \
+                                    pool_threads=pool_threads)
+        self.batch_size = batch_size
         
     @staticmethod
     def fid2eid(file_id, chunk_id):
@@ -353,38 +846,107 @@ class Pinecone(object):
         chunk_id = int(chunk_id)
         return (file_id, chunk_id)
         
-    def insert(self, file_id="", embeddings=[], namespace=''):
+    def insert(self, file_id="", embeddings=[], namespace='', start=0):
+        # 分批upsert，各批次并行发送；start为第一个向量的chunk_id
         if not file_id or not embeddings or not namespace:
             return
         vectors = []
-        for chunk_id in range(len(embeddings)):
+        for i, embedding in enumerate(embeddings):
+            chunk_id = start + i
             embed_id = self.fid2eid(file_id, chunk_id)
-            vectors.append((embed_id, embeddings[chunk_id]))
-        response = self.index.upsert(vectors=vectors, namespace=namespace)
-        return response.upserted_count
+            metadata = {'file_id': file_id, 'chunk_id': chunk_id}
+            vectors.append((embed_id, list(embedding), metadata))
+        return self.upsert(vectors, namespace)
+
+    def upsert(self, vectors, namespace):
+        # vectors为(embed_id, values, metadata)：返回写入的向量数
+        requests = []
+        for i in range(0, len(vectors), self.batch_size):
+            requests.append(self.index.upsert( \
+                            vectors=vectors[i:i+self.batch_size], \
+                            namespace=namespace, async_req=True))
+        return sum(request.get().upserted_count for request in requests)
     
-    def query(self, query_embedding, namespace='', top_k=1):
+    @shared('pinecone_query')
+    def query(self, query_embedding, namespace='', top_k=1, \
+              include_values=False):
         if not namespace:
             return None
         result = self.index.query(vector=query_embedding, \
-                            namespace=namespace, top_k=top_k)
+                            namespace=namespace, top_k=top_k, \
+                            include_values=include_values)
         if not result.matches:
             return None
         embed_ids = [match.id for match in result.matches]
         scores = [match.score for match in result.matches]
         n = len(result.matches)
         ids = [self.eid2fid(embed_ids[i]) for i in range(n)]
+        if include_values:
+            # 同时返回向量：用于mmr重排
+            values = [match.values for match in result.matches]
+            return (scores, ids, values)
         return (scores, ids)
         
     def delete(self, file_id="", num_embeddings=0, namespace=''):
-        if not file_id or not num_embeddings or not namespace:
+        # 按metadata删除文件的全部向量；num_embeddings>0时再按id删除，
+        # 清理没有metadata的旧向量
+        if not file_id or not namespace:
             return
-        ids = []
-        for chunk_id in range(num_embeddings):
-            embed_id = self.fid2eid(file_id, chunk_id)
-            ids.append(embed_id)
-        self.index.delete(ids=ids, namespace=namespace)
+        self.index.delete(filter={'file_id': {'$eq': file_id}}, \
+                          namespace=namespace)
+        ids = [self.fid2eid(file_id, chunk_id) \
+               for chunk_id in range(num_embeddings)]
+        self.delete_ids(ids, namespace)
         return 
+
+    def fetch(self, file_id="", num_embeddings=0, namespace=''):
+        # 按chunk_id的顺序取回文件的全部向量：有缺少的返回None
+        ids = [self.fid2eid(file_id, chunk_id) \
+               for chunk_id in range(num_embeddings)]
+        vectors = {}
+        for i in range(0, len(ids), self.BATCH_SIZE):
+            result = self.index.fetch(ids=ids[i:i+self.BATCH_SIZE], \
+                                      namespace=namespace)
+            vectors.update((embed_id, vector.values) \
+                           for embed_id, vector in result.vectors.items())
+        if len(vectors) < len(ids):
+            return None
+        return [vectors[embed_id] for embed_id in ids]
+
+    def delete_ids(self, ids, namespace):
+        for i in range(0, len(ids), self.DELETE_BATCH):
+            self.index.delete(ids=ids[i:i+self.DELETE_BATCH], \
+                              namespace=namespace)
+
+    def count(self, namespace):
+        stats = self.index.describe_index_stats()
+        summary = stats.namespaces.get(namespace)
+        return summary.vector_count if summary else 0
+
+    def list_namespaces(self):
+        return list(self.index.describe_index_stats().namespaces)
+
+    def find_orphans(self, namespace, files):
+        """
+        files为file_id -> 节选数(MongoDB中的有效文件)。
+        孤儿向量：file_id不在files中，或chunk_id超出文件的节选数。
+        Pinecone没有列出id的接口：用metadata过滤的query找出这些向量。
+        """
+        probe = [1.0] + [0.0] * (self.dimension - 1)
+        orphans = set()
+        # 已删除文件的向量：一次最多返回MAX_TOP_K个，删除后再找一次
+        query_filter = {'file_id': {'$nin': list(files)}} if files else None
+        result = self.index.query(vector=probe, namespace=namespace, \
+                                  top_k=self.MAX_TOP_K, filter=query_filter)
+        orphans.update(match.id for match in result.matches)
+        # 节选数变少后残留的向量
+        for file_id, num_chunks in files.items():
+            query_filter = {'file_id': {'$eq': file_id}, \
+                            'chunk_id': {'$gte': num_chunks}}
+            result = self.index.query(vector=probe, namespace=namespace, \
+                                      top_k=self.MAX_TOP_K, filter=query_filter)
+            orphans.update(match.id for match in result.matches)
+        return sorted(orphans)
     
         
 class Google(object):
@@ -392,7 +954,9 @@ class Google(object):
         # 获得Serpapi的API KEY
         self.serp_api_key = serp_api_key
         
+    @shared('google_search')
     def search(self, query):
+        from serpapi import GoogleSearch
         results = GoogleSearch({
                 'q': query,    
                 'engine': 'google',
@@ -413,49 +977,123 @@ class Google(object):
         return webpages
     
         
-class Chroma(object):
-    def __init__(self, openai_api_key, openai_embed_model):
-        self.client = chromadb.Client()
-        # chromadb内置的OpenAI Embedding Function：之后不用的
-        openai = embedding_functions.OpenAIEmbeddingFunction(\
-            api_key=openai_api_key, model_name=openai_embed_model)
-        # 创建集合
-        #self.collection = self.client.create_collection(name='kqa')
-        self.collection = self.client.get_or_create_collection(name='kqa', \
-                                embedding_function=openai)
-        
-    def insert(self, chunks=[], embeddings=[], title='', link=''):
-        if not chunks or not embeddings or not title or not link:
-            return 
-        # 获取集合的文档数 
-        num = self.collection.count()
-        ids = [str(num+i) for i in range(len(chunks))]
-        metadatas = [{'title':title, 'link':link} for i in range(len(chunks))]
-        # 传入embeddings参数：不会调用chromadb内置的embedding function
-        self.collection.add(ids=ids, documents=chunks, \
-                    embeddings=embeddings, metadatas=metadatas)
-        
-    def query(self, query_embedding, n_results=1):
-        try:
-            results = self.collection.query([query_embedding], \
-                                            n_results=n_results, \
-                include=['documents', 'embeddings', 'metadatas', 'distances'])
-        except chromadb.errors.NotEnoughElementsException as err:
-            print(err)
+class WebCorpus(object):
+    """
+    持久的网页知识库(SQLite)：按URL存储网页的节选和嵌入向量，所有用户共享。
+    未过期(ttl秒内抓取)的网页不再重新抓取；内容哈希相同的网页不再重新嵌入；
+    总大小超过max_bytes时按最近访问时间淘汰。
+    """
+    def __init__(self, path, ttl=7*24*3600, max_bytes=256*1024*1024, \
+                 dtype='float16'):
+        self.path = path
+        self.ttl = ttl                # 网页的新鲜期(秒)
+        self.max_bytes = max_bytes    # 节选和向量的总字节数上限
+        self.dtype = dtype            # 向量的存储精度：见vec.DTYPES
+        self.local = threading.local()  # 每个线程一个SQLite连接
+        self.lock = threading.Lock()
+        self.execute("""CREATE TABLE IF NOT EXISTS pages (
+                            url TEXT PRIMARY KEY, title TEXT,
+                            content_hash TEXT, dim INTEGER,
+                            chunks TEXT, vectors BLOB, nbytes INTEGER,
+                            fetched_at REAL, accessed_at REAL)""")
+        self.execute("CREATE INDEX IF NOT EXISTS pages_hash " \
+                     "ON pages (content_hash)")
+        self.execute("CREATE INDEX IF NOT EXISTS pages_accessed " \
+                     "ON pages (accessed_at)")
+
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # WAL模式：多个worker进程可以同时读写
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        conn = self.connect()
+        with conn:  # 自动提交或回滚
+            return conn.execute(sql, params).fetchall()
+
+    def is_fresh(self, url, dim):
+        # 网页已索引、没过期且向量维数与当前嵌入后端一致
+        rows = self.execute("SELECT fetched_at FROM pages " \
+                            "WHERE url=? AND dim=?", (url, dim))
+        return bool(rows) and time.time() - rows[0][0] < self.ttl
+
+    def reuse(self, url, title, content_hash, dim):
+        # 内容相同的网页已经嵌入过：复制节选和向量，不用再嵌入
+        rows = self.execute("SELECT chunks, vectors, nbytes FROM pages " \
+                            "WHERE content_hash=? AND dim=? LIMIT 1", \
+                            (content_hash, dim))
+        if not rows:
+            return False
+        chunks, vectors, nbytes = rows[0]
+        self.save(url, title, content_hash, dim, chunks, vectors, nbytes)
+        return True
+
+    def insert(self, url='', title='', content_hash='', chunks=[], \
+               embeddings=[]):
+        if not url or not chunks or not embeddings:
+            return
+        packed = vec.PackedVectors.pack(embeddings, self.dtype)
+        chunks_json = json.dumps(chunks, ensure_ascii=False)
+        vectors = packed.to_bytes()
+        nbytes = len(chunks_json.encode('utf-8')) + len(vectors)
+        self.save(url, title, content_hash, packed.data.shape[1], \
+                  chunks_json, vectors, nbytes)
+        self.evict()
+
+    def save(self, url, title, content_hash, dim, chunks, vectors, nbytes):
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO pages VALUES " \
+                     "(?, ?, ?, ?, ?, ?, ?, ?, ?)", (url, title, \
+                     content_hash, dim, chunks, vectors, nbytes, now, now))
+
+    def query(self, query_embedding, urls=[], n_results=1):
+        # 在给定的网页中检索：返回(documents, embeddings, links)
+        if not urls:
             return None
-        # results有'documents','embeddings','metadatas','distances'四个属性
-        return results
-            
-    def clear(self):
-        # 获取集合的文档数 
-        num = self.collection.count()
-        ids = [str(i) for i in range(num)]
-        self.collection.delete(ids=ids)
-        
-    def __del__(self):
-        # 执行del obj(或者程序结束)会触发__del__析构函数
-        # 删除集合
-        self.client.delete_collection(name='kqa')
-        
-        
-        
\ No newline at end of file
+        marks = ",".join("?" * len(urls))
+        rows = self.execute("SELECT url, chunks, vectors FROM pages " \
+                            f"WHERE url IN ({marks}) AND dim=?", \
+                            (*urls, len(query_embedding)))
+        if not rows:
+            return None
+        self.execute(f"UPDATE pages SET accessed_at=? WHERE url IN ({marks})", \
+                     (time.time(), *urls))
+        documents, links, packs = [], [], []
+        for url, chunks, vectors in rows:
+            chunks = json.loads(chunks)
+            documents.extend(chunks)
+            links.extend([url] * len(chunks))
+            packs.append(vec.PackedVectors.from_bytes(vectors).unpack())
+        matrix = np.concatenate(packs)
+        scores = vec.cosine_scores(query_embedding, matrix)
+        top = np.argsort(-scores)[:n_results]
+        return ([documents[i] for i in top], \
+                [matrix[i].tolist() for i in top], [links[i] for i in top])
+
+    def evict(self):
+        # 超过大小上限：先删过期的网页，再按最近访问时间删除
+        with self.lock:
+            self.execute("DELETE FROM pages WHERE fetched_at < ?", \
+                         (time.time() - self.ttl,))
+            total = self.execute("SELECT COALESCE(SUM(nbytes), 0) " \
+                                 "FROM pages")[0][0]
+            while total > self.max_bytes:
+                rows = self.execute("SELECT url, nbytes FROM pages " \
+                                    "ORDER BY accessed_at LIMIT 64")
+                if not rows:
+                    break
+                for url, nbytes in rows:
+                    self.execute("DELETE FROM pages WHERE url=?", (url,))
+                    total -= nbytes
+                    if total <= self.max_bytes:
+                        break
+
+    def stats(self):
+        count, total = self.execute("SELECT COUNT(*), " \
+                                    "COALESCE(SUM(nbytes), 0) FROM pages")[0]
+        return {'pages': count, 'bytes': total}
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# loadtest: 用本地假上游压测main.app，比较sync和gevent两种worker的并发能力
+# 用法：python loadtest.py --worker-class gevent --users 1,8,32,128
+# OpenAI和Pinecone用fakes代替；默认用mongomock(pip install mongomock，
+# 数据在worker内存中，单worker足够)，--mongo-url可指定本地mongod
+import os, sys, time, json, argparse, tempfile, threading, subprocess
+import requests
+import fakes
+import harness
+
+
+def serve(args):
+    # 在子进程中启动gunicorn：单worker即单核
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"127.0.0.1:{args.port}")
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', args.worker_class)
+            self.cfg.set('worker_connections', args.connections)
+            self.cfg.set('timeout', 120)
+
+        def load(self):
+            # worker中加载应用：gevent已经完成monkey patch
+            import kqa
+            fakes.FakePinecone.latency = args.latency
+            kqa.Pinecone = fakes.FakePinecone
+            if args.mongomock:
+                import mongomock
+                kqa.pymongo = mongomock
+            import main
+            return main.app
+
+    Application().run()
+
+
+def wait_ready(base_url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def run_level(base_url, num_users, duration, chattype):
+    sessions = [harness.prepare_user(base_url, f"loadtest{i}", i) \
+                for i in range(num_users)]
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def user_loop(http):
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                ok = harness.ask(http, base_url, "压测问题：检索向量的延迟", \
+                                 chattype)
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+            harness.delete_answer(http, base_url)
+
+    threads = [threading.Thread(target=user_loop, args=(http,)) \
+               for http in sessions]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    latencies.sort()
+    return {'users': num_users, 'requests': len(latencies), \
+            'errors': errors[0], 'rps': len(latencies) / elapsed, \
+            'p50': harness.percentile(latencies, 0.50), \
+            'p95': harness.percentile(latencies, 0.95), \
+            'p99': harness.percentile(latencies, 0.99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main.app并发压测")
+    parser.add_argument('--worker-class', default='gevent', \
+                        choices=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--users', default="1,8,32,128", \
+                        help="逗号分隔的并发用户数")
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--latency', type=float, default=0.5, \
+                        help="假上游每次调用的延迟(秒)")
+    parser.add_argument('--chattype', default='document', \
+                        choices=['direct', 'document'])
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--min-score', type=float, default=0.1, \
+                        help="RETRIEVE_MIN_SCORE：假嵌入的相似度低于真实模型")
+    parser.add_argument('--mongo-url', default=os.getenv("MONGO_URL"), \
+                        help="使用本地mongod而不是mongomock")
+    parser.add_argument('--mongomock', action='store_true', \
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--log', help="服务输出(含每次问答的阶段耗时)写入该文件")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    upstream = fakes.FakeOpenAIServer(latency=args.latency).start()
+    env = dict(os.environ, DEPLOY_ON_RAILWAY="1", PORT=str(args.port), \
+               OPENAI_API_KEY="sk-fake", OPENAI_CHAT_MODEL="gpt-3.5-turbo", \
+               OPENAI_EMBED_MODEL="text-embedding-ada-002", \
+               PINECONE_API_KEY="fake", SERP_API_KEY="fake", \
+               MONGO_URL=args.mongo_url or "mongodb://localhost:27017", \
+               OPENAI_API_BASE=upstream.api_base, \
+               TMP_DIR=tempfile.mkdtemp(prefix="kqa-loadtest-"), \
+               RETRIEVE_MIN_SCORE=str(args.min_score))
+    server = subprocess.Popen([sys.executable, __file__, '--serve', \
+                '--worker-class', args.worker_class, \
+                '--connections', str(args.connections), \
+                '--latency', str(args.latency), '--port', str(args.port)] + \
+                ([] if args.mongo_url else ['--mongomock']), \
+                env=env, stdout=open(args.log, 'w') if args.log \
+                                                else subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        if not wait_ready(base_url):
+            print("服务启动失败")
+            return
+        # 合格标准：p95延迟不超过上游理想延迟的2倍
+        ideal = args.latency * (3 if args.chattype == 'document' else 1)
+        capacity = 0
+        for num_users in [int(n) for n in args.users.split(',')]:
+            result = run_level(base_url, num_users, args.duration, \
+                               args.chattype)
+            print(json.dumps(result, ensure_ascii=False))
+            if result['p95'] is not None and result['errors'] == 0 \
+                    and result['p95'] <= 2 * ideal:
+                capacity = num_users
+        print(f"worker={args.worker_class} 单核并发用户容量≈{capacity}")
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.stop()
+
+
+if __name__ == '__main__':
+    main()
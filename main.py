@@ -1,13 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import os, re, datetime, json
-import numpy as np
+import os, re, datetime, json, importlib, tempfile
 from flask import Flask, request, redirect, url_for, render_template, session
-import kqa
-from unstructured.partition.doc import partition_doc
-from unstructured.partition.docx import partition_docx
-import fitz
-from fproc import crawl_webpage
+import kqa, vec, retr, sflight, prio
+from flow import Flow, fanout, background
+from fproc import crawl_webpage, ParsePool
 
 # 获取全局变量
 if os.getenv("DEPLOY_ON_RAILWAY"):
@@ -32,6 +29,58 @@ else:
     MONGO_URL = config['MONGO_URL']
     os.environ['HTTP_PROXY'] = config['HTTP_PROXY']
     os.environ['HTTPS_PROXY'] = config['HTTPS_PROXY']
+
+# 获取可选变量：railway部署从环境变量获取，本地部署从配置文件获取
+def get_option(key, default=None):
+    if os.getenv("DEPLOY_ON_RAILWAY"):
+        return os.getenv(key, default)
+    return config.get(key, default)
+
+# OpenAI API地址：为空时使用官方地址，压测时指向本地的假服务
+OPENAI_API_BASE = get_option("OPENAI_API_BASE")
+# 预加载模块：逗号分隔的模块名，如"numpy,tiktoken,pymongo"
+PRELOAD_MODULES = get_option("PRELOAD_MODULES", "")
+# 文件解析进程池：进程数、每个任务的超时(秒)、每个进程的内存上限(MB)
+PARSE_WORKERS = int(get_option("PARSE_WORKERS", 2))
+PARSE_TIMEOUT = int(get_option("PARSE_TIMEOUT", 60))
+PARSE_MEMORY_MB = int(get_option("PARSE_MEMORY_MB", 1024))
+# 嵌入后端：openai为OpenAI的Embedding API，local为本地sentence-transformers模型
+EMBED_BACKEND = get_option("EMBED_BACKEND", "openai")
+LOCAL_EMBED_MODEL = get_option("LOCAL_EMBED_MODEL", \
+                "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+LOCAL_EMBED_THREADS = int(get_option("LOCAL_EMBED_THREADS", 0))
+LOCAL_EMBED_QUANTIZE = str(get_option("LOCAL_EMBED_QUANTIZE", "")).lower() \
+                                            in ("1", "true", "yes")
+LOCAL_EMBED_BATCH = int(get_option("LOCAL_EMBED_BATCH", 64))
+LOCAL_EMBED_WAIT_MS = float(get_option("LOCAL_EMBED_WAIT_MS", 5))
+# 检索：召回数、最多节选数、相似度下限、节选token预算、重排方式(mmr/cross-encoder/none)
+RETRIEVE_FETCH_K = int(get_option("RETRIEVE_FETCH_K", 10))
+RETRIEVE_MAX_CONTEXTS = int(get_option("RETRIEVE_MAX_CONTEXTS", 3))
+RETRIEVE_MIN_SCORE = float(get_option("RETRIEVE_MIN_SCORE", 0.8))
+RETRIEVE_TOKEN_BUDGET = int(get_option("RETRIEVE_TOKEN_BUDGET", 1536))
+RETRIEVE_RERANK = get_option("RETRIEVE_RERANK", "mmr")
+# file文档中段落的压缩方式：''或'zstd'
+PARAGRAPH_COMPRESSION = get_option("PARAGRAPH_COMPRESSION", "")
+# 跨worker合并相同上游调用的锁目录(为空则只在worker内合并)和结果共享窗口(秒)
+SINGLEFLIGHT_DIR = get_option("SINGLEFLIGHT_DIR", "")
+SINGLEFLIGHT_WINDOW = float(get_option("SINGLEFLIGHT_WINDOW", 2))
+# 网页知识库：SQLite文件路径、网页的新鲜期(小时)、大小上限(MB)
+WEB_CORPUS_PATH = get_option("WEB_CORPUS_PATH", "./webcorpus.db")
+WEB_CORPUS_TTL_HOURS = float(get_option("WEB_CORPUS_TTL_HOURS", 24 * 7))
+WEB_CORPUS_MAX_MB = int(get_option("WEB_CORPUS_MAX_MB", 256))
+# 优先级调度：上游调用(OpenAI)的总槽位数(0为不限，问答不排队)和摄取可占用的槽位数，
+# 同时进行的摄取(上传/抓取)数和排队上限，超过上限的上传提示稍后再试
+UPSTREAM_SLOTS = int(get_option("UPSTREAM_SLOTS", 0))
+UPSTREAM_BULK_SLOTS = int(get_option("UPSTREAM_BULK_SLOTS", 4))
+INGEST_WORKERS = int(get_option("INGEST_WORKERS", PARSE_WORKERS))
+INGEST_QUEUE = int(get_option("INGEST_QUEUE", 16))
+# 跨worker调度的锁目录：为空时摄取的上限只在worker内有效(sync worker下不起作用)
+PRIO_LOCK_DIR = get_option("PRIO_LOCK_DIR", "")
+# Pinecone：同时进行的upsert请求数和每次upsert的向量数
+PINECONE_POOL_THREADS = int(get_option("PINECONE_POOL_THREADS", 4))
+PINECONE_BATCH = int(get_option("PINECONE_BATCH", 100))
+# 上传文件的临时目录
+TMP_DIR = get_option("TMP_DIR", tempfile.gettempdir())
 print("================")
 print(f'PORT={PORT}')
 print(f'OPENAI_API_KEY={OPENAI_API_KEY}')
@@ -40,6 +89,31 @@ print(f'OPENAI_EMBED_MODEL={OPENAI_EMBED_MODEL}')
 print(f'PINECONE_API_KEY={PINECONE_API_KEY}')
 print(f'SERP_API_KEY={SERP_API_KEY}')
 print(f'MONGO_URL={MONGO_URL}')
+print(f'OPENAI_API_BASE={OPENAI_API_BASE}')
+print(f'PRELOAD_MODULES={PRELOAD_MODULES}')
+print(f'PARSE_WORKERS={PARSE_WORKERS}')
+print(f'PARSE_TIMEOUT={PARSE_TIMEOUT}')
+print(f'PARSE_MEMORY_MB={PARSE_MEMORY_MB}')
+print(f'EMBED_BACKEND={EMBED_BACKEND}')
+if EMBED_BACKEND == 'local':
+    print(f'LOCAL_EMBED_MODEL={LOCAL_EMBED_MODEL}')
+    print(f'LOCAL_EMBED_THREADS={LOCAL_EMBED_THREADS}')
+    print(f'LOCAL_EMBED_QUANTIZE={LOCAL_EMBED_QUANTIZE}')
+print(f'PARAGRAPH_COMPRESSION={PARAGRAPH_COMPRESSION}')
+print(f'SINGLEFLIGHT_DIR={SINGLEFLIGHT_DIR}')
+print(f'WEB_CORPUS_PATH={WEB_CORPUS_PATH}')
+print(f'RETRIEVE_FETCH_K={RETRIEVE_FETCH_K}')
+print(f'RETRIEVE_MAX_CONTEXTS={RETRIEVE_MAX_CONTEXTS}')
+print(f'RETRIEVE_MIN_SCORE={RETRIEVE_MIN_SCORE}')
+print(f'RETRIEVE_TOKEN_BUDGET={RETRIEVE_TOKEN_BUDGET}')
+print(f'RETRIEVE_RERANK={RETRIEVE_RERANK}')
+print(f'PINECONE_POOL_THREADS={PINECONE_POOL_THREADS}')
+print(f'PINECONE_BATCH={PINECONE_BATCH}')
+print(f'UPSTREAM_SLOTS={UPSTREAM_SLOTS}')
+print(f'UPSTREAM_BULK_SLOTS={UPSTREAM_BULK_SLOTS}')
+print(f'INGEST_WORKERS={INGEST_WORKERS}')
+print(f'INGEST_QUEUE={INGEST_QUEUE}')
+print(f'PRIO_LOCK_DIR={PRIO_LOCK_DIR}')
 print("================")
 
 # 创建Flask应用
@@ -53,16 +127,56 @@ app.config['PERMANENT_SESSION_LIFETIME'] = datetime.timedelta(days=1)
 # 限制上传文件不超过16MB
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  
 
+# 合并同时发生的相同上游调用：搜索、抓取、嵌入query和向量查询
+sflight.flight.configure(lock_dir=SINGLEFLIGHT_DIR, window=SINGLEFLIGHT_WINDOW)
+# 以下服务都在首次使用时才创建：导入main不访问网络，登录页可以立即响应
+# 创建本地嵌入模型：模型在首次嵌入时才加载
+if EMBED_BACKEND == 'local':
+    embedder = kqa.LocalEmbedder(LOCAL_EMBED_MODEL, \
+                    num_threads=LOCAL_EMBED_THREADS, \
+                    quantize=LOCAL_EMBED_QUANTIZE, \
+                    max_batch=LOCAL_EMBED_BATCH, \
+                    max_wait=LOCAL_EMBED_WAIT_MS / 1000)
+else:
+    embedder = None
+# 上游调用闸门：只限制摄取的并发，问答默认不受限(gevent下一个worker可有上千个请求)
+upstream = prio.Gate('upstream', slots=UPSTREAM_SLOTS, \
+                     bulk_slots=UPSTREAM_BULK_SLOTS, lock_dir=PRIO_LOCK_DIR)
+# 摄取闸门：每个用户同时只摄取一个文件，其他用户的文件轮流进行
+ingest = prio.Gate('ingest', slots=INGEST_WORKERS, user_slots=1, \
+                   max_queue=INGEST_QUEUE, lock_dir=PRIO_LOCK_DIR)
 # 创建OpenAI模型：chat模型和embedding模型
-openai = kqa.OpenAI(OPENAI_API_KEY, OPENAI_CHAT_MODEL, OPENAI_EMBED_MODEL)
+openai = kqa.Lazy(kqa.OpenAI, OPENAI_API_KEY, OPENAI_CHAT_MODEL, \
+                  OPENAI_EMBED_MODEL, OPENAI_API_BASE, embedder, upstream)
 # 创建MongoDB数据库
-mongo = kqa.MongoDB(MONGO_URL)
-# 创建Pinecone向量数据库
-pinecone = kqa.Pinecone(PINECONE_API_KEY)
+mongo = kqa.Lazy(kqa.MongoDB, MONGO_URL, \
+                 compression=PARAGRAPH_COMPRESSION)
+# 创建Pinecone向量数据库：索引维数与嵌入后端一致
+pinecone = kqa.Lazy(lambda: kqa.Pinecone(PINECONE_API_KEY, \
+                                         dimension=openai.embed_dim, \
+                                         pool_threads=PINECONE_POOL_THREADS, \
+                                         batch_size=PINECONE_BATCH))
 # 创建Google搜索引擎
-google = kqa.Google(SERP_API_KEY)
-# 创建Chroma向量数据库
-chroma = kqa.Chroma(OPENAI_API_KEY, OPENAI_EMBED_MODEL)
+google = kqa.Lazy(kqa.Google, SERP_API_KEY)
+# 创建网页知识库：抓取和嵌入过的网页在所有用户之间共享
+corpus = kqa.Lazy(kqa.WebCorpus, WEB_CORPUS_PATH, \
+                  ttl=WEB_CORPUS_TTL_HOURS * 3600, \
+                  max_bytes=WEB_CORPUS_MAX_MB * 1024 * 1024)
+# 创建文件解析进程池：解析进程在首次解析时才启动
+parse_pool = ParsePool(max_workers=PARSE_WORKERS, timeout=PARSE_TIMEOUT, \
+                       memory_limit=PARSE_MEMORY_MB * 1024 * 1024)
+# 创建检索流水线：重排模型在首次使用时加载，之后在进程内复用
+retriever = retr.Retriever(fetch_k=RETRIEVE_FETCH_K, \
+                           max_contexts=RETRIEVE_MAX_CONTEXTS, \
+                           min_score=RETRIEVE_MIN_SCORE, \
+                           token_budget=RETRIEVE_TOKEN_BUDGET, \
+                           rerank=RETRIEVE_RERANK)
+
+# 预加载模式(gunicorn --preload)：在主进程中导入重型模块，fork后各worker共享
+# 网络客户端不在这里创建，fork之后由各worker在首次使用时创建
+for module_name in PRELOAD_MODULES.split(','):
+    if module_name.strip():
+        importlib.import_module(module_name.strip())
 
 # 获取当前会话的状态
 # state in ['register', 'login', 'prompt', 'chat']
@@ -134,8 +248,11 @@ def login():
         session['messages'] = [{"role": "system", "content": user['prompt']}]
         session['contexts'] = []
         session['chattype'] = 'direct'
-    titles = [f['title'] for f in mongo.find_files_by_user(name)]
+    titles = [f['title'] for f in \
+              mongo.find_files_by_user(name, fields=['title'])]
     session['titles'] = titles
+    # 后台预取用户的文件：之后的文档问答直接命中缓存
+    background(mongo.prefetch_files, name)
     print(f"登录: 姓名={name}, uid={session['uid']}")
     return redirect(url_for('index'))
 
@@ -158,6 +275,19 @@ def logout():
 
 @app.route('/fetch', methods=['POST'])
 def fetch():
+    # 摄取是后台任务：排队等待摄取槽位，其中的上游调用让位于问答
+    if 'name' not in session:
+        return redirect(url_for('index'))
+    name = session['name']
+    try:
+        with prio.job(prio.BULK, name), ingest.slot():
+            return fetch_document()
+    except prio.Busy:
+        print(f"获取: 排队已满 姓名={name}")
+        return render_template('index.html', state=get_current_state(), \
+                               file_msg="上传的文件太多，请稍后再试")
+
+def fetch_document():
     submit = request.form.get('submit')
     if submit == '上传文件':
         if 'file' not in request.files:
@@ -172,23 +302,19 @@ def fetch():
         filetype = filetype.lower()
         if filetype not in ['.txt', '.pdf', '.doc', '.docx']:
             return redirect(url_for('index'))    # 永不进入：前端做了限制。
-        filepath = "./tmp" # 保存到临时文件中
-        file.save(filepath)
-        if filetype == '.txt':
-            with open(filepath, "r") as fp:
-                paragraphs = fp.readlines()
-        elif filetype == '.pdf':
-            paragraphs = []
-            with fitz.open(filepath) as doc:
-                for page in doc:
-                    text = page.get_text()
-                    paragraphs.extend(text.split('\n'))
-        elif filetype == '.doc':
-            paragraphs = partition_doc(filename=filepath)
-        elif filetype == '.docx':
-            paragraphs = partition_docx(filename=filepath)
-        paragraphs = [str(p).strip() for p in paragraphs \
-                                      if str(p).strip() != ""]
+        # 保存到临时文件中：并发上传互不覆盖
+        fd, filepath = tempfile.mkstemp(suffix=filetype, dir=TMP_DIR)
+        os.close(fd)
+        try:
+            file.save(filepath)
+            # 在进程池中解析文件
+            okey, data = parse_pool.parse(filepath, filetype)
+        finally:
+            os.remove(filepath)
+        if not okey:
+            return render_template('index.html', \
+                        state=get_current_state(), file_msg=data)
+        paragraphs = data
         if not paragraphs:    
             return render_template('index.html', \
                         state=get_current_state(), file_msg="文件没有内容")
@@ -205,6 +331,9 @@ def fetch():
         return redirect(url_for('index'))    # 永不进入
     name = session['name']
     titles = session['titles']
+    # 其他用户(或同名的旧文件)上传过相同内容：直接复用切分结果和向量，不再嵌入
+    # 要在删除旧文件之前查找：旧文件是内容的最后一个引用时，删除会连带删除内容
+    content = mongo.find_content(paragraphs=paragraphs, dim=openai.embed_dim)
     # 同名文件：要先删除文件和嵌入
     if title in titles:
         file_doc = mongo.find_file(name=name, title=title)
@@ -219,10 +348,14 @@ def fetch():
             # 删除标题
             titles.pop(titles.index(title))
     # 嵌入文件
-    chunks, embeddings = openai.embed_document(paragraphs)
-    # 新增文件
+    if content:
+        spans, embeddings = content
+    else:
+        chunks, spans = openai.chunk_document(paragraphs)
+        embeddings = openai.embed_texts(chunks) if chunks else []
+    # 新增文件：节选只存储在全文中的区间，相同内容只存一份
     file_id = mongo.insert_file(name=name, title=title, \
-                         paragraphs=paragraphs, chunks=chunks)
+                paragraphs=paragraphs, spans=spans, embeddings=embeddings)
     if file_id == None:
         return render_template('index.html', state=get_current_state(), \
                                                    file_msg="插入文件失败")
@@ -231,7 +364,8 @@ def fetch():
     # 更新会话
     titles.append(title)
     session['titles'] = titles
-    print(f"获取: 标题={title} 段落数={len(paragraphs)}, 节选数={len(chunks)}")
+    print(f"获取: 标题={title} 段落数={len(paragraphs)}, 节选数={len(spans)}" \
+          f", 复用={content is not None}")
     return redirect(url_for('index'))
 
 @app.route('/delete', methods=['POST'])
@@ -325,42 +459,91 @@ def prompt():
     print(f"提示：提示={prompt}")
     return redirect(url_for('index'))
 
-def search_context(query, query_embedding):
-    # 搜索网页
-    webpages = google.search(query=query)
-    if not webpages:
+def crawl_and_embed(webpage):
+    # 抓取并嵌入一个网页：多个网页在扇出线程池中并行处理
+    # 已在知识库中且没过期的网页直接使用，返回网页的url
+    url = webpage['link']
+    if corpus.is_fresh(url, openai.embed_dim):
+        return url
+    okey, data = crawl_webpage(url=url)
+    if not okey:
         return None
-    # webpages != None
-    # 遍历网页
-    for webpage in webpages:
-        # 抓取网页
-        url = webpage['link']
-        okey, data = crawl_webpage(url=url)
-        if not okey:
-            continue
-        title, paragraphs = data
-        if len(paragraphs) == 0:
-            continue
-        title = webpage['title'] # 优先使用Google的title而非自动提取的title
+    title, paragraphs = data
+    if len(paragraphs) == 0:
+        return None
+    title = webpage['title'] # 优先使用Google的title而非自动提取的title
+    # 内容没变(或与其他网页相同)时不用重新嵌入
+    content_hash = kqa.hash_paragraphs(paragraphs)
+    if not corpus.reuse(url, title, content_hash, openai.embed_dim):
         # 嵌入网页
         chunks, embeddings = openai.embed_document(paragraphs)
         # 新增嵌入
-        chroma.insert(chunks=chunks, embeddings=embeddings, \
-                      title=title, link=url)
-    # 查询嵌入
-    results = chroma.query(query_embedding=query_embedding, n_results=3)
-    # 删除嵌入
-    chroma.clear()
-    if not results or len(results) == 0:
+        corpus.insert(url=url, title=title, content_hash=content_hash, \
+                      chunks=chunks, embeddings=embeddings)
+    return url
+
+def search_context(urls, query_embedding):
+    # urls为crawl_and_embed的结果：在这些网页的节选中检索
+    urls = [url for url in urls if url]
+    if not urls:
         return None
-    # len(results) > 0
-    documents = results['documents'][0]
-    embeddings = results['embeddings'][0]
-    #titles = [md['title'] for md in results['metadatas'][0]]
-    links = [md['link'] for md in results['metadatas'][0]]
-    #distances = results['distances'][0]
-    return (documents, embeddings, links)
-        
+    return corpus.query(query_embedding=query_embedding, urls=urls, \
+                        n_results=retriever.fetch_k)
+
+def relevant_file_ids(result):
+    # 相关度够高的节选所在的文件
+    if not result:
+        return []
+    scores, ids = result[:2]
+    return [ids[i][0] for i, score in enumerate(scores) \
+            if score > retriever.min_score]
+
+def document_candidates(result, file_docs):
+    # 文档检索的候选节选：链接在请求线程中用url_for生成
+    candidates = []
+    if not result:  # 最相关的文档嵌入不存在
+        return candidates
+    scores, ids = result[:2]
+    values = result[2] if len(result) > 2 else [None] * len(ids)
+    for i, score in enumerate(scores):
+        file_id, chunk_id = ids[i]
+        file_doc = file_docs.get(file_id)
+        if file_doc and chunk_id < len(file_doc['chunks']):
+            candidates.append({'fid':file_id, 'cid':chunk_id, 'score':score, \
+                               'chunk':file_doc['chunks'][chunk_id], \
+                               'embedding':values[i]})
+    return candidates
+
+def search_candidates(result, question_embedding):
+    # 网页搜索的候选节选
+    candidates = []
+    if not result:  # 最相关的网页嵌入不存在
+        return candidates
+    documents, embeddings, links = result
+    # 一次算出所有结果的相关度
+    scores = vec.cosine_scores(question_embedding, embeddings)
+    for i, score in enumerate(scores):
+        candidates.append({'link':links[i], 'score':float(score), \
+                           'chunk':documents[i], 'embedding':embeddings[i]})
+    return candidates
+
+def answer_with_context(messages, question, context):
+    # 有上下文时把节选拼进问题，不修改会话中的messages
+    if context == []:
+        # 直接问答
+        return openai.answer_question(messages + \
+                                [{"role":"user", "content":question}])
+    # 间接问答：节选数由检索流水线按token预算决定
+    contexted_question = retr.build_question(question, context)
+    return openai.answer_question(messages + \
+                            [{"role":"user", "content":contexted_question}])
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    # 调度指标：各优先级的排队数、占用数和等待时间(秒)
+    return {'upstream': upstream.stats(), 'ingest': ingest.stats(), \
+            'singleflight': sflight.flight.stats()}
+
 @app.route('/chat', methods=['POST'])
 def chat():
     submit = request.form.get('submit')
@@ -386,64 +569,46 @@ def chat():
         return redirect(url_for('index'))
     # 获取上下文：context
     chattype = request.form.get('chattype')  # or session['chattype']
-    context = []   # 单个context里面有多个chunks
+    name = session['name']
+    messages = session['messages']
+    contexts = session['contexts']
+    # 问答阶段图：互不依赖的阶段并发执行
+    chat_flow = Flow()
     if chattype == 'document':
-        # 检索文档
-        name = session['name']
-        question_embedding = openai.embed_query(query=question)
-        result = pinecone.query(query_embedding=question_embedding, \
-                                                 namespace=name, top_k=3)
-        if result:  # 最相关的文档嵌入存在
-            scores, ids = result
-            for i, score in enumerate(scores):
-                if score > 0.8: # 相关度要大于0.8
-                    file_id, chunk_id = ids[i]
-                    file_doc = mongo.find_file(name=name, file_id=file_id)
-                    if file_doc:  # 相应的文件存在
-                        chunk = file_doc['chunks'][chunk_id]
-                        link = url_for('read', fid=file_id, cid=chunk_id)
-                        context.append({'link':link, 'chunk':chunk})
+        # 检索文档：多召回一些候选，同一批文件一次查询，再去重、重排和打包
+        chat_flow.add('embed', lambda: openai.embed_query(query=question))
+        chat_flow.add('query', lambda question_embedding: pinecone.query( \
+                    query_embedding=question_embedding, namespace=name, \
+                    top_k=retriever.fetch_k, \
+                    include_values=retriever.needs_embeddings), ['embed'])
+        chat_flow.add('files', lambda result: mongo.find_files(name=name, \
+                    file_ids=relevant_file_ids(result)), ['query'])
+        chat_flow.add('candidates', document_candidates, ['query', 'files'])
     elif chattype == 'search':
-        # 搜索网页
-        question_embedding = openai.embed_query(query=question)
-        result = search_context(question, question_embedding)
-        if result:  # 最相关的网页嵌入存在
-            documents, embeddings, links = result
-            for i, embedding in enumerate(embeddings):
-                score = np.array(question_embedding).dot(np.array(embedding))
-                if score > 0.8:  # 相关度要大与0.8
-                    document = documents[i]
-                    link = links[i]
-                    context.append({'link':link, 'chunk':document})
+        # 搜索网页：搜索不依赖问题的嵌入，两者同时进行；多个网页并行抓取
+        chat_flow.add('embed', lambda: openai.embed_query(query=question))
+        chat_flow.add('search', lambda: google.search(query=question))
+        chat_flow.add('crawl', lambda webpages: \
+                    fanout(crawl_and_embed, webpages or []), ['search'])
+        chat_flow.add('context', search_context, ['crawl', 'embed'])
+        chat_flow.add('candidates', search_candidates, ['context', 'embed'])
+    if chattype in ['document', 'search']:
+        chat_flow.add('rerank', lambda question_embedding, candidates: \
+                    retriever.select(question, question_embedding, \
+                    candidates), ['embed', 'candidates'])
     else:  # chattype == 'direct'
-        pass  # context == []
+        chat_flow.add('rerank', lambda: [])  # context == []
     # 问答服务：answer
-    messages = session['messages']
-    contexts = session['contexts']
-    if context == []:
-        # 直接问答
-        messages.append({"role":"user", "content":question})
-        okey, result = openai.answer_question(messages)
-    else:  # context != []   
-        # 间接问答
-        if len(context) == 1:
-            contexted_question = "根据以下内容回答问题：\n内容：" \
-                        + context[0]['chunk'] + "\n问题：" + question
-        elif len(context) == 2:
-            contexted_question = "根据以下两个文章节选回答问题：\n节选一：" \
-                                + context[0]['chunk'] + "\n节选二：" \
-                                + context[1]['chunk'] + "\n问题：" + question
-        elif len(context) == 3:
-            contexted_question = "根据以下三个文章节选回答问题：\n节选一：" \
-                                + context[0]['chunk'] + "\n节选二：" \
-                                + context[1]['chunk'] + "\n节选三：" \
-                                + context[2]['chunk'] + "\n问题：" + question
-        else:
-            return redirect(url_for('index'))  # 永不进入
-        messages.append({"role":"user", "content":contexted_question})
-        okey, result = openai.answer_question(messages)
-        messages.pop(-1)
-        messages.append({"role":"user", "content":question})
+    chat_flow.add('answer', lambda context: \
+                  answer_with_context(messages, question, context), ['rerank'])
+    results = chat_flow.run()
+    print(f"阶段: {chat_flow.report()}")
+    # 会话中只保存链接和节选
+    context = [{'link':c.get('link') or \
+                       url_for('read', fid=c['fid'], cid=c['cid']), \
+                'chunk':c['chunk']} for c in results['rerank']]
+    okey, result = results['answer']
+    messages.append({"role":"user", "content":question})
     if not okey:
         err_msg = result
         return render_template('index.html', \
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# prio: priority scheduling，问答和文件摄取之间的优先级调度、公平份额和准入控制
+import os, time, fcntl, hashlib, threading, contextlib, collections
+from sflight import lock_any
+
+# 优先级：数值小的先获得槽位
+INTERACTIVE = 0  # 问答(/chat)：用户在等答案
+BULK = 1         # 摄取(/fetch)：解析、切分和大批量嵌入
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+# 当前线程(gevent下为当前协程)所属的任务：(优先级, 用户名)
+_local = threading.local()
+
+
+class Busy(Exception):
+    # 后台任务排队已满：调用者应提示稍后再试，而不是一直等待
+    pass
+
+
+@contextlib.contextmanager
+def job(priority, user=''):
+    # 标记当前线程的任务类别：其中的上游调用按这个优先级排队
+    previous = getattr(_local, 'job', None)
+    _local.job = (priority, user)
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+
+def current_job():
+    # 没有标记的线程(如问答的阶段线程)按交互请求处理
+    return getattr(_local, 'job', None) or (INTERACTIVE, '')
+
+
+class Waiter(object):
+    def __init__(self, priority, user, seq):
+        self.priority = priority
+        self.user = user
+        self.seq = seq            # 到达顺序
+        self.arrived = time.time()
+
+
+class Gate(object):
+    """
+    有限个槽位的优先级闸门：
+    等待者按(优先级, 该用户已占用的槽位数, 到达顺序)获得槽位，
+    同一优先级内占用少的用户先得到槽位(公平份额)；
+    slots为总槽位数(0为不限，交互请求不排队)，后台任务最多同时占用bulk_slots个，
+    每个用户的后台任务最多占用user_slots个槽位(0为不限)；
+    后台任务的排队数达到max_queue时直接拒绝(0为不限)，交互请求总是排队。
+    lock_dir不为空时，后台任务的槽位还要在lock_dir下用文件锁占用：
+    同一台机器上的所有worker共享bulk_slots和user_slots的上限。
+    """
+    WAIT_SAMPLES = 1024  # 保留最近这么多次的等待时间，用于计算p95
+
+    def __init__(self, name, slots=0, bulk_slots=None, user_slots=0, \
+                 max_queue=0, lock_dir=None):
+        self.name = name
+        self.slots = slots
+        self.bulk_slots = slots if bulk_slots is None else bulk_slots
+        self.user_slots = user_slots
+        self.max_queue = max_queue
+        self.lock_dir = lock_dir
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self.cond = threading.Condition()
+        self.waiting = []  # [Waiter]
+        self.seq = 0
+        self.active = collections.Counter()       # priority -> 占用数
+        self.user_active = collections.Counter()  # (priority, user) -> 占用数
+        self.granted = collections.Counter()      # priority -> 获得槽位的次数
+        self.rejected = collections.Counter()     # priority -> 拒绝次数
+        self.waits = {p: collections.deque(maxlen=self.WAIT_SAMPLES) \
+                      for p in PRIORITY_NAMES}
+
+    def eligible(self, waiter):
+        if self.slots and sum(self.active.values()) >= self.slots:
+            return False
+        if waiter.priority == BULK:
+            if self.bulk_slots and self.active[BULK] >= self.bulk_slots:
+                return False
+            if self.user_slots and \
+                    self.user_active[(BULK, waiter.user)] >= self.user_slots:
+                return False
+        return True
+
+    def pick(self):
+        # 下一个获得槽位的等待者：没有可以放行的就返回None
+        candidates = [w for w in self.waiting if self.eligible(w)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda w: (w.priority, \
+                   self.user_active[(w.priority, w.user)], w.seq))
+
+    def acquire(self, priority=INTERACTIVE, user=''):
+        # 返回跨worker的锁文件：release时一起释放
+        with self.cond:
+            if priority == BULK and self.max_queue and \
+                    self.queue_depth(BULK) >= self.max_queue:
+                self.rejected[priority] += 1
+                raise Busy(f"{self.name}排队已满")
+            self.seq += 1
+            waiter = Waiter(priority, user, self.seq)
+            self.waiting.append(waiter)
+            while self.pick() is not waiter:
+                self.cond.wait()
+            self.waiting.remove(waiter)
+            self.active[priority] += 1
+            self.user_active[(priority, user)] += 1
+            # 可能还有空闲槽位：让其他等待者重新检查
+            self.cond.notify_all()
+        locks = []
+        if priority == BULK and self.lock_dir:
+            try:
+                locks = self.lock_slots(user)
+            except BaseException:
+                self.release(priority, user)
+                raise
+        with self.cond:
+            self.granted[priority] += 1
+            self.waits[priority].append(time.time() - waiter.arrived)
+        return locks
+
+    def lock_slots(self, user):
+        # 先占用户的槽位再占全局的槽位：顺序固定，不会互相等待而死锁
+        locks = []
+        try:
+            if self.user_slots:
+                digest = hashlib.sha1(user.encode('utf-8')).hexdigest()[:16]
+                locks.append(self.lock_file(f"{self.name}-user-{digest}", \
+                                            self.user_slots))
+            if self.bulk_slots:
+                locks.append(self.lock_file(f"{self.name}-bulk", \
+                                            self.bulk_slots))
+        except BaseException:
+            self.unlock(locks)
+            raise
+        return locks
+
+    def lock_file(self, prefix, count):
+        # count个锁文件就是count个槽位：占用其中任意一个
+        return lock_any([os.path.join(self.lock_dir, f"{prefix}.{i}.lock") \
+                         for i in range(count)])
+
+    @staticmethod
+    def unlock(locks):
+        for lock_file in locks:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def release(self, priority=INTERACTIVE, user='', locks=()):
+        self.unlock(locks)
+        with self.cond:
+            self.active[priority] -= 1
+            self.user_active[(priority, user)] -= 1
+            if self.user_active[(priority, user)] <= 0:
+                del self.user_active[(priority, user)]
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        # 按当前线程的任务类别占用一个槽位
+        priority, user = current_job()
+        locks = self.acquire(priority, user)
+        try:
+            yield
+        finally:
+            self.release(priority, user, locks)
+
+    def queue_depth(self, priority):
+        return sum(1 for w in self.waiting if w.priority == priority)
+
+    def stats(self):
+        with self.cond:
+            result = {'slots': self.slots, 'bulk_slots': self.bulk_slots}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self.waits[priority])
+                result[name] = {'queued': self.queue_depth(priority), \
+                    'active': self.active[priority], \
+                    'granted': self.granted[priority], \
+                    'rejected': self.rejected[priority], \
+                    'wait_mean': sum(waits) / len(waits) if waits else 0.0, \
+                    'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0, \
+                    'wait_max': waits[-1] if waits else 0.0}
+            return result
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# reconcile: 对账MongoDB中的文件和Pinecone中的向量，删除孤儿向量
+# 用法：python reconcile.py --namespace alice [--dry-run]
+#       python reconcile.py --all
+# 需要main的配置(config.json或railway环境变量)
+import sys, argparse
+import main
+
+MAX_ROUNDS = 100  # 每轮最多找出Pinecone.MAX_TOP_K个孤儿
+
+
+def valid_files(namespace):
+    # MongoDB中该用户的文件：file_id -> 节选数
+    files = {}
+    for file_doc in main.mongo.find_files_by_user(namespace, \
+                                        fields=['num_chunks', 'chunks']):
+        files[str(file_doc['_id'])] = main.mongo.num_chunks(file_doc)
+    return files
+
+
+def still_orphans(namespace, orphans):
+    # 删除前重新读取文件：对账期间新上传或导入的文件的向量不能删除
+    # 上传和导入都先写MongoDB再写向量，所以向量存在时文件已经在files中
+    files = valid_files(namespace)
+    kept = []
+    for embed_id in orphans:
+        file_id, chunk_id = main.pinecone.eid2fid(embed_id)
+        if file_id not in files or chunk_id >= files[file_id]:
+            kept.append(embed_id)
+    return kept
+
+
+def reconcile(namespace, dry_run=False):
+    removed = set()
+    for _ in range(MAX_ROUNDS):
+        # 每轮重新读取文件；删除生效前可能再次找到同一批向量
+        files = valid_files(namespace)
+        orphans = [o for o in main.pinecone.find_orphans(namespace, files) \
+                   if o not in removed]
+        orphans = still_orphans(namespace, orphans)
+        if not orphans:
+            break
+        print(f"{namespace}: 孤儿向量{len(orphans)}个，如{orphans[:3]}")
+        removed.update(orphans)
+        if dry_run:
+            break
+        main.pinecone.delete_ids(orphans, namespace)
+    removed = len(removed)
+    files = valid_files(namespace)
+    expected = sum(files.values())
+    count = main.pinecone.count(namespace)
+    print(f"{namespace}: 文件数={len(files)} 应有向量={expected} " \
+          f"孤儿={removed}{'(未删除)' if dry_run else ''} 现有向量={count}")
+    if not dry_run and count != expected:
+        # 没有metadata的旧向量无法按过滤条件找出：需要重新上传这些文件
+        print(f"{namespace}: 向量数仍不一致，差{count - expected}个")
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="删除Pinecone中的孤儿向量")
+    parser.add_argument('--namespace', action='append', default=[], \
+                        help="用户名(可重复)")
+    parser.add_argument('--all', action='store_true', \
+                        help="对账索引中的所有namespace")
+    parser.add_argument('--dry-run', action='store_true', \
+                        help="只列出孤儿向量，不删除")
+    args = parser.parse_args()
+    namespaces = args.namespace
+    if args.all:
+        namespaces = main.pinecone.list_namespaces()
+    if not namespaces:
+        parser.print_help()
+        sys.exit(1)
+    total = sum(reconcile(namespace, args.dry_run) for namespace in namespaces)
+    print(f"共{len(namespaces)}个namespace，孤儿向量{total}个")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# retr: retrieval，检索候选节选的去重、重排和按token预算打包
+import threading
+import numpy as np
+import tiktoken
+import vec
+
+# 重排模型在进程内只加载一次：model_name -> CrossEncoder
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+
+def get_cross_encoder(model_name):
+    with _cross_encoders_lock:
+        if model_name not in _cross_encoders:
+            from sentence_transformers import CrossEncoder
+            _cross_encoders[model_name] = CrossEncoder(model_name)
+        return _cross_encoders[model_name]
+
+
+def shingles(text, size=8):
+    # 字符级的n-gram集合：中文没有空格，按字符切分
+    text = "".join(text.split())
+    if len(text) <= size:
+        return {text}
+    return {text[i:i+size] for i in range(len(text) - size + 1)}
+
+
+def containment(lhs, rhs):
+    # 两个shingle集合的重叠度：交集占较小集合的比例
+    if not lhs or not rhs:
+        return 0.0
+    return len(lhs & rhs) / min(len(lhs), len(rhs))
+
+
+class Retriever(object):
+    """
+    候选节选 -> 过滤低分 -> 去掉重叠 -> 重排 -> 按token预算打包。
+    候选是dict：'chunk'节选文本，'link'链接，'score'向量相似度，
+    'embedding'节选向量(mmr重排需要)。
+    """
+    def __init__(self, fetch_k=10, max_contexts=3, min_score=0.8, \
+                 token_budget=1536, rerank='mmr', mmr_lambda=0.7, \
+                 dedup_threshold=0.5, \
+                 cross_encoder_model='cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'):
+        self.fetch_k = fetch_k              # 向量库召回的候选数
+        self.max_contexts = max_contexts    # 最多放进提示的节选数
+        self.min_score = min_score          # 向量相似度的下限
+        self.token_budget = token_budget    # 节选的总token数上限
+        self.rerank = rerank                # 'mmr'、'cross-encoder'或'none'
+        self.mmr_lambda = mmr_lambda        # mmr中相关度的权重
+        self.dedup_threshold = dedup_threshold
+        self.cross_encoder_model = cross_encoder_model
+        self._encoding = None
+
+    @property
+    def needs_embeddings(self):
+        return self.rerank == 'mmr'
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+
+    def select(self, question, question_embedding, candidates):
+        candidates = [c for c in candidates if c['score'] > self.min_score]
+        candidates.sort(key=lambda c: c['score'], reverse=True)
+        candidates = self.deduplicate(candidates)
+        if self.rerank == 'mmr':
+            candidates = self.rerank_mmr(candidates)
+        elif self.rerank == 'cross-encoder':
+            candidates = self.rerank_cross_encoder(question, candidates)
+        return self.pack(candidates)
+
+    def deduplicate(self, candidates):
+        # merge_chunks生成的相邻节选有重叠：保留分数高的那个
+        kept, kept_shingles = [], []
+        for candidate in candidates:
+            candidate_shingles = shingles(candidate['chunk'])
+            if all(containment(candidate_shingles, s) < self.dedup_threshold \
+                   for s in kept_shingles):
+                kept.append(candidate)
+                kept_shingles.append(candidate_shingles)
+        return kept
+
+    def rerank_mmr(self, candidates):
+        # 最大边际相关：兼顾与问题的相关度和与已选节选的差异
+        if len(candidates) <= 1 or \
+                any(c.get('embedding') is None for c in candidates):
+            return candidates
+        matrix = vec.as_matrix([c['embedding'] for c in candidates])
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1), 1e-12)[:, None]
+        similarity = matrix.dot(matrix.T)
+        relevance = np.array([c['score'] for c in candidates])
+        selected, remaining = [], list(range(len(candidates)))
+        while remaining:
+            if selected:
+                redundancy = similarity[remaining][:, selected].max(axis=1)
+            else:
+                redundancy = np.zeros(len(remaining))
+            mmr = self.mmr_lambda * relevance[remaining] \
+                  - (1 - self.mmr_lambda) * redundancy
+            best = remaining[int(np.argmax(mmr))]
+            selected.append(best)
+            remaining.remove(best)
+        return [candidates[i] for i in selected]
+
+    def rerank_cross_encoder(self, question, candidates):
+        if len(candidates) <= 1:
+            return candidates
+        model = get_cross_encoder(self.cross_encoder_model)
+        scores = model.predict([(question, c['chunk']) for c in candidates])
+        order = np.argsort(-np.asarray(scores))
+        return [candidates[i] for i in order]
+
+    def pack(self, candidates):
+        # 按顺序放入节选，直到节选数或token数用完
+        context, used = [], 0
+        for candidate in candidates:
+            if len(context) >= self.max_contexts:
+                break
+            num_tokens = len(self.encoding.encode(candidate['chunk']))
+            if used + num_tokens > self.token_budget:
+                continue  # 放不下就试下一个较短的节选
+            context.append(candidate)
+            used += num_tokens
+        return context
+
+
+CHINESE_DIGITS = "零一二三四五六七八九"
+
+
+def chinese_number(n):
+    # 1~99的中文数字：节选一、节选十二
+    if n < 10:
+        return CHINESE_DIGITS[n]
+    tens, ones = divmod(n, 10)
+    text = ("" if tens == 1 else CHINESE_DIGITS[tens]) + "十"
+    return text + (CHINESE_DIGITS[ones] if ones else "")
+
+
+def build_question(question, context):
+    # 把节选和问题拼成间接问答的提示
+    if len(context) == 1:
+        return "根据以下内容回答问题：\n内容：" + context[0]['chunk'] \
+               + "\n问题：" + question
+    if len(context) == 2:
+        count = "两"
+    else:
+        count = chinese_number(len(context))
+    text = f"根据以下{count}个文章节选回答问题："
+    for i, item in enumerate(context):
+        text += f"\n节选{chinese_number(i+1)}：" + item['chunk']
+    return text + "\n问题：" + question
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# sflight: single flight，同时发生的相同上游调用只执行一次，共享同一个结果
+import os, time, fcntl, pickle, hashlib, functools, threading
+
+POLL_INTERVAL = 0.01  # 等待文件锁时的轮询间隔(秒)
+
+
+def lock_any(paths):
+    # 对paths中任意一个文件加排他锁，返回打开的锁文件(关闭即释放)
+    # 非阻塞加锁并轮询：gevent下不会阻塞整个worker
+    while True:
+        for path in paths:
+            lock_file = open(path, 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                lock_file.close()
+        time.sleep(POLL_INTERVAL)
+
+
+class Call(object):
+    # 一次进行中的调用：跟随者等待done后读取结果
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+    """
+    进程内：相同key的并发调用由第一个线程(领头者)执行，其余线程等待并共享结果。
+    跨进程(可选)：lock_dir下用文件锁选出领头的worker，结果短暂写入文件，
+    其他worker拿到锁后在window秒内直接读取这个结果。
+    """
+    SWEEP_EVERY = 256  # 每执行这么多次调用清理一次过期的结果文件
+
+    def __init__(self, lock_dir=None, window=2.0):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> Call
+        self.lock_dir = lock_dir
+        self.window = window
+        self.num_calls = 0
+        self.num_shared = 0
+
+    def configure(self, lock_dir=None, window=2.0):
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        self.lock_dir = lock_dir
+        self.window = window
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = Call()
+                leader = True
+            else:
+                call.followers += 1
+                leader = False
+        if not leader:
+            call.done.wait()
+            with self.lock:
+                self.num_shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            if self.lock_dir:
+                call.result = self.do_shared(key, func, *args, **kwargs)
+            else:
+                call.result = func(*args, **kwargs)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                self.num_calls += 1
+            call.done.set()
+        return call.result
+
+    def do_shared(self, key, func, *args, **kwargs):
+        path = os.path.join(self.lock_dir, key)
+        with lock_any([path + '.lock']) as lock_file:
+            try:
+                # 其他worker刚刚算出的结果
+                try:
+                    if time.time() - os.path.getmtime(path) < self.window:
+                        with open(path, 'rb') as fp:
+                            return pickle.load(fp)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+                result = func(*args, **kwargs)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as fp:
+                    pickle.dump(result, fp)
+                os.replace(temp_path, path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                if self.num_calls % self.SWEEP_EVERY == 0:
+                    self.sweep()
+
+    def sweep(self):
+        # 删除过期的结果文件和锁文件
+        now = time.time()
+        for file_name in os.listdir(self.lock_dir):
+            path = os.path.join(self.lock_dir, file_name)
+            try:
+                if now - os.path.getmtime(path) > 60 * self.window:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.num_calls, 'shared': self.num_shared, \
+                    'in_flight': len(self.calls)}
+
+
+# 进程内共享的实例：main根据配置决定是否启用跨进程
+flight = SingleFlight()
+
+
+def make_key(name, args, kwargs):
+    text = repr((name, args, sorted(kwargs.items())))
+    return name + '-' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def shared(name, method=True):
+    # 装饰器：method为True时忽略第一个参数self
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(name, args[1:] if method else args, kwargs)
+            return flight.do(key, func, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# startup: 启动耗时报告，分别统计导入耗时和各服务首次创建的耗时
+# 用法：python startup.py [--init]   (--init会真正连接各上游服务)
+import sys, time, json, argparse, subprocess
+
+# 重型模块：每个模块在独立的子进程中导入，互不影响
+HEAVY_MODULES = ['numpy', 'flask', 'pymongo', 'openai', 'tiktoken', \
+                 'pinecone', 'serpapi', 'sentence_transformers', \
+                 'fitz', 'unstructured.partition.doc', \
+                 'unstructured.partition.docx']
+# main中延迟创建的服务
+SERVICES = ['openai', 'mongo', 'pinecone', 'google', 'corpus']
+
+
+def time_import(module_name):
+    code = "import time; t = time.perf_counter(); " \
+           f"import {module_name}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, '-c', code], \
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None  # 模块没有安装
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动耗时报告")
+    parser.add_argument('--init', action='store_true', \
+                        help="同时统计各服务首次创建的耗时(会访问网络)")
+    parser.add_argument('--json', action='store_true', help="输出JSON")
+    args = parser.parse_args()
+
+    report = {'imports': {}, 'services': {}}
+    for module_name in HEAVY_MODULES:
+        report['imports'][module_name] = time_import(module_name)
+    # 导入main并请求登录页：这是worker可以开始服务之前的耗时
+    start = time.perf_counter()
+    import main
+    report['import_main'] = time.perf_counter() - start
+    start = time.perf_counter()
+    response = main.app.test_client().get('/')
+    report['first_login_page'] = time.perf_counter() - start
+    report['first_login_status'] = response.status_code
+    if args.init:
+        for service_name in SERVICES:
+            start = time.perf_counter()
+            getattr(main, service_name).get()
+            report['services'][service_name] = time.perf_counter() - start
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print("================")
+    print("导入耗时(独立进程):")
+    for module_name, seconds in report['imports'].items():
+        cost = "未安装" if seconds is None else f"{seconds:.3f}s"
+        print(f"  {module_name:<32}{cost}")
+    print(f"导入main: {report['import_main']:.3f}s")
+    print(f"首次登录页: {report['first_login_page']:.3f}s " \
+          f"(status={report['first_login_status']})")
+    if args.init:
+        print("服务首次创建耗时:")
+        for service_name, seconds in report['services'].items():
+            print(f"  {service_name:<32}{seconds:.3f}s")
+    print("================")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vec: vector encoding，嵌入向量的紧凑表示和打分
+import io, sys, time, argparse
+import numpy as np
+
+# 支持的存储精度：每个1536维向量分别占6144、3072、1536字节
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def as_matrix(embeddings):
+    # list of list或ndarray -> float32矩阵
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    return matrix
+
+
+def cosine_scores(query_embedding, embeddings):
+    # 一次算出query与所有向量的余弦相似度
+    query = np.asarray(query_embedding, dtype=np.float32)
+    matrix = as_matrix(embeddings)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    return matrix.dot(query) / np.maximum(norms, 1e-12)
+
+
+class PackedVectors(object):
+    """
+    紧凑存储的向量矩阵：
+    float32/float16直接存储，int8按向量做标量量化(每个向量一个scale)，
+    同时保存原始向量的模长，用于余弦相似度。
+    """
+    BLOCK_ROWS = 1024  # 打分时每次转换为float32的行数
+    def __init__(self, data, scales, norms):
+        self.data = data        # (n, dim)的float32/float16/int8矩阵
+        self.scales = scales    # (n,)的float32，只有int8使用
+        self.norms = norms      # (n,)的float32，原始向量的模长
+
+    @classmethod
+    def pack(cls, embeddings, dtype='int8'):
+        if dtype not in DTYPES:
+            raise ValueError(f"不支持的精度: {dtype}")
+        matrix = as_matrix(embeddings)
+        norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+        scales = np.ones(len(matrix), dtype=np.float32)
+        if dtype == 'int8':
+            scales = np.abs(matrix).max(axis=1) / 127.0
+            scales = np.maximum(scales, 1e-12).astype(np.float32)
+            data = np.round(matrix / scales[:, None]).astype(np.int8)
+        else:
+            data = matrix.astype(dtype)
+        return cls(data, scales, norms)
+
+    @property
+    def dtype(self):
+        return self.data.dtype.name
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.scales.nbytes + self.norms.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def unpack(self):
+        # 还原为float32矩阵(int8有量化误差)
+        matrix = self.data.astype(np.float32)
+        if self.dtype == 'int8':
+            matrix *= self.scales[:, None]
+        return matrix
+
+    def dot(self, query_embedding):
+        # 近似内积：分块转为float32后用BLAS点积，int8再乘scale，
+        # 不用一次还原整个矩阵
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if self.dtype == 'float32':
+            scores = self.data.dot(query)
+        else:
+            scores = np.empty(len(self.data), dtype=np.float32)
+            for i in range(0, len(self.data), self.BLOCK_ROWS):
+                block = self.data[i:i+self.BLOCK_ROWS].astype(np.float32)
+                scores[i:i+self.BLOCK_ROWS] = block.dot(query)
+        if self.dtype == 'int8':
+            scores *= self.scales
+        return scores
+
+    def cosine(self, query_embedding):
+        query_norm = np.linalg.norm(np.asarray(query_embedding, \
+                                               dtype=np.float32))
+        norms = np.maximum(self.norms * query_norm, 1e-12)
+        return self.dot(query_embedding) / norms
+
+    def search(self, query_embedding, top_k=3, full=None, oversample=4):
+        """
+        返回(scores, indexes)，按相似度从高到低。
+        full为全精度向量矩阵时，先近似召回top_k*oversample个候选，
+        再用全精度重新打分，找回量化损失的准确率。
+        """
+        scores = self.cosine(query_embedding)
+        if full is None:
+            top = np.argsort(-scores)[:top_k]
+            return (scores[top], top)
+        candidates = np.argsort(-scores)[:top_k * oversample]
+        exact = cosine_scores(query_embedding, as_matrix(full)[candidates])
+        order = np.argsort(-exact)[:top_k]
+        return (exact[order], candidates[order])
+
+    def to_bytes(self):
+        # 序列化为.npz字节串：可存入MongoDB的Binary字段或磁盘文件
+        buffer = io.BytesIO()
+        np.savez(buffer, data=self.data, scales=self.scales, norms=self.norms)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        arrays = np.load(io.BytesIO(blob))
+        return cls(arrays['data'], arrays['scales'], arrays['norms'])
+
+
+def load_namespace(name):
+    # 从Pinecone取回某个用户的全部节选向量(需要main的配置)
+    import main
+    vectors = []
+    for file_doc in main.mongo.find_files_by_user(name):
+        file_id = str(file_doc['_id'])
+        ids = [main.pinecone.fid2eid(file_id, chunk_id) \
+               for chunk_id in range(main.mongo.num_chunks(file_doc))]
+        for i in range(0, len(ids), 100):
+            result = main.pinecone.index.fetch(ids=ids[i:i+100], \
+                                               namespace=name)
+            vectors.extend(v.values for v in result.vectors.values())
+    return as_matrix(vectors)
+
+
+def benchmark(matrix, num_queries=100, top_k=3, oversample=4):
+    # 用一部分节选向量做query，比较各精度相对float32精确检索的召回率
+    rng = np.random.RandomState(0)
+    num_queries = min(num_queries, len(matrix) // 2)
+    picks = rng.choice(len(matrix), num_queries, replace=False)
+    mask = np.ones(len(matrix), dtype=bool)
+    mask[picks] = False
+    queries, corpus = matrix[picks], matrix[mask]
+    # 加一点噪声：query不会与某个节选完全相同
+    queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+    exact = PackedVectors.pack(corpus, 'float32')
+    truth = [set(exact.search(q, top_k)[1]) for q in queries]
+    print(f"向量数={len(corpus)} 维数={matrix.shape[1]} " \
+          f"query数={num_queries} top_k={top_k}")
+    for dtype in DTYPES:
+        packed = PackedVectors.pack(corpus, dtype)
+        for full in ([None, corpus] if dtype != 'float32' else [None]):
+            start = time.perf_counter()
+            found = [set(packed.search(q, top_k, full, oversample)[1]) \
+                     for q in queries]
+            elapsed = (time.perf_counter() - start) / num_queries
+            recall = np.mean([len(found[i] & truth[i]) / top_k \
+                              for i in range(num_queries)])
+            rerank = "+重排" if full is not None else ""
+            print(f"{dtype+rerank:<14} 字节/向量={packed.nbytes/len(packed):<8.0f}" \
+                  f" recall@{top_k}={recall:.4f} 每次检索={elapsed*1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="向量量化的召回率基准")
+    parser.add_argument('--npy', help="(n, dim)的float32向量矩阵文件")
+    parser.add_argument('--namespace', help="从Pinecone取回该用户的向量")
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--oversample', type=int, default=4)
+    args = parser.parse_args()
+    if args.npy:
+        matrix = as_matrix(np.load(args.npy))
+    elif args.namespace:
+        matrix = load_namespace(args.namespace)
+    else:
+        parser.print_help()
+        sys.exit(1)
+    benchmark(matrix, args.queries, args.top_k, args.oversample)